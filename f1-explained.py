@@ -2,9 +2,32 @@ import streamlit as st
 import requests
 import pandas as pd
 import numpy as np
+import os
+import gzip
+import hashlib
+import json
+import logging
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as pa_ipc
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler
+from sklearn.neighbors import KDTree
+try:
+    import fcntl
+except ImportError:     # Windows: sin bloqueo entre procesos para el vigilante
+    fcntl = None
 
 # ─────────────────────────────────────────────
 #  TRADUCCIONES
@@ -15,15 +38,22 @@ TRANSLATIONS = {
         "menu_title": "🏁 Menú Principal",
         "go_to": "Ir a:",
         "analyzer": "📊 Analizador de Telemetría",
+        "season": "🗓️ Temporada",
         "faq": "❓ FAQ & Metodología",
         "settings": "⚙️ Configuración",
         "year": "Año",
         "sampling": "Muestreo (Cada N puntos)",
         "min_speed": "Velocidad Mínima",
+        "interpolate_pos": "Interpolar posiciones (mapa más suave)",
+        "phase_engine": "Motor de fases",
+        "engine_kmeans": "KMeans (IA)",
+        "engine_thresholds": "Umbrales (rápido)",
         "clear_data": "🗑️ Borrar Datos Guardados",
         "grand_prix": "Gran Premio",
         "session": "Sesión",
         "driver": "Piloto",
+        "index_loading": "Cargando el calendario de la temporada…",
+        "drivers_pending": "La API aún no publicó los pilotos de esta sesión.",
         "language": "🌐 Idioma",
         # Main view
         "page_title": "🏎️ F1 2026 IA: Analizador de Telemetría",
@@ -32,7 +62,17 @@ TRANSLATIONS = {
         "select_lap": "Selecciona la vuelta:",
         "analyze_lap": "📊 Analizar Vuelta Seleccionada",
         "analyzing": "Analizando...",
+        "reloading_data": "Recargando datos liberados de memoria...",
+        "instrumentation": "📊 Instrumentación",
+        "mem_used": "Memoria de sesiones: {usado:.1f} / {total:.0f} MB",
+        "mem_stats": "Esta sesión: {propio:.1f} MB · {entradas} datos de {sesiones} sesiones · {expulsiones} expulsados · {recalculos} recalculados",
+        "stage_queued": "en cola…",
+        "stage_download": "descargando telemetría…",
+        "stage_align": "alineando posiciones…",
+        "stage_ia": "clasificando fases (IA)…",
+        "stage_energy": "calculando energía…",
         "api_error": "Error en API ({endpoint}): {e}",
+        "no_telemetry": "La API no devolvió telemetría (car_data/location) para esta vuelta.",
         # Metrics
         "lap_spend": "Gasto Vuelta",
         "recovery": "Recuperación",
@@ -50,6 +90,61 @@ TRANSLATIONS = {
         "circuit_normal": "🏁 Normal — 8.5 MJ",
         "circuit_limited": "⚠️ Recuperación limitada — 8.0 MJ",
         "circuit_highspeed": "🚀 Alta velocidad — 5.0 MJ",
+        "segments_title": "Energía por Segmento",
+        "agreement_title": "Concordancia KMeans vs Umbrales",
+        "agreement_default": "Umbrales por defecto",
+        "agreement_calibrated": "Calibrados en esta vuelta",
+        "agreement_table": "Filas: KMeans · Columnas: umbrales por defecto (muestras)",
+        "agreement_compute": "Calcular concordancia (KMeans + calibración)",
+        "calibrated_thresholds": "Umbrales calibrados",
+        "season_title": "Resumen de la Temporada",
+        "season_empty": "Todavía no hay vueltas materializadas. Se agregan solas al analizar vueltas o cargar la tabla de energía de una sesión con los filtros por defecto.",
+        "season_stored": "{laps} vueltas materializadas en {circuits} circuitos · consultas en {ms:.0f} ms",
+        "season_db_error": "Último error al guardar agregados: {e}",
+        "season_drivers": "Pilotos (media por vuelta)",
+        "season_segments": "Clipping por segmento del circuito (media por vuelta)",
+        "season_laps": "Vueltas materializadas del circuito",
+        "laps_count": "Vueltas",
+        "clipping_events": "Inicios de clipping",
+        "v_clipping_onset": "Vel. máx. al iniciar clipping (km/h)",
+        "straight": "Recta",
+        "corner": "Curva",
+        "segment": "Segmento",
+        "dist_start": "Inicio (dist.)",
+        "dist_end": "Fin (dist.)",
+        "deploy_mj": "Deployment (MJ)",
+        "harvest_mj": "Harvesting (MJ)",
+        "clipping_s": "Clipping (s)",
+        "compare_title": "Comparación",
+        "compare_drivers": "Pilotos a comparar",
+        "compare_laps": "Vueltas a comparar",
+        "compare_btn": "📈 Comparar Vueltas",
+        "compare_ref": "Referencia: {ref}",
+        "distance": "Distancia",
+        "delta_time": "Δ Tiempo (s)",
+        "delta_energy": "Δ Energía acum. (MJ)",
+        "speed_kmh": "Velocidad (km/h)",
+        "lap_energy_title": "⚡ Energía por Vuelta",
+        "lap_energy_progress": "Calculando energía: {done}/{total} vueltas",
+        "lap_energy_error": "No se pudo calcular la energía de la sesión: {e}",
+        "lap_energy_failed": "No se pudieron calcular las vueltas {laps}: {e}",
+        "lap": "Vuelta",
+        "lap_time": "Tiempo",
+        "net_mj": "Balance (MJ)",
+        "race_title": "Carrera",
+        "race_btn": "🔋 Simular Batería en Carrera (todos los pilotos)",
+        "race_progress": "Procesando vueltas de todos los pilotos: {done}/{total}",
+        "race_soc": "SoC al final de cada vuelta (MJ)",
+        "race_final_soc": "SoC final (MJ)",
+        "race_starved_laps": "Vueltas sin batería",
+        "race_starved_s": "Tiempo sin batería (s)",
+        "race_wasted": "Harvest perdido (MJ)",
+        "sweep_title": "🔬 Barrido What-If del Modelo de Energía",
+        "sweep_param": "Parámetro (eje X)",
+        "sweep_param2": "Segundo parámetro (opcional)",
+        "sweep_range": "Rango (× valor por defecto)",
+        "sweep_steps": "Pasos por parámetro",
+        "sweep_none": "—",
         # FAQ
         "faq_title": "❓ Preguntas Frecuentes y Metodología",
         "faq_content": """
@@ -93,15 +188,22 @@ Con un MGU-K de **350 kW**, los 8.5 MJ permiten usar la potencia eléctrica máx
         "menu_title": "🏁 Main Menu",
         "go_to": "Go to:",
         "analyzer": "📊 Telemetry Analyzer",
+        "season": "🗓️ Season Overview",
         "faq": "❓ FAQ & Methodology",
         "settings": "⚙️ Settings",
         "year": "Year",
         "sampling": "Sampling (Every N points)",
         "min_speed": "Minimum Speed",
+        "interpolate_pos": "Interpolate positions (smoother map)",
+        "phase_engine": "Phase engine",
+        "engine_kmeans": "KMeans (AI)",
+        "engine_thresholds": "Thresholds (fast)",
         "clear_data": "🗑️ Clear Saved Data",
         "grand_prix": "Grand Prix",
         "session": "Session",
         "driver": "Driver",
+        "index_loading": "Loading the season calendar…",
+        "drivers_pending": "The API has not published the drivers for this session yet.",
         "language": "🌐 Language",
         "page_title": "🏎️ F1 2026 AI: Telemetry Analyzer",
         "load_laps": "🚀 Load Lap History",
@@ -109,7 +211,17 @@ Con un MGU-K de **350 kW**, los 8.5 MJ permiten usar la potencia eléctrica máx
         "select_lap": "Select lap:",
         "analyze_lap": "📊 Analyze Selected Lap",
         "analyzing": "Analyzing...",
+        "reloading_data": "Reloading data evicted from memory...",
+        "instrumentation": "📊 Instrumentation",
+        "mem_used": "Session memory: {usado:.1f} / {total:.0f} MB",
+        "mem_stats": "This session: {propio:.1f} MB · {entradas} entries from {sesiones} sessions · {expulsiones} evicted · {recalculos} recomputed",
+        "stage_queued": "queued…",
+        "stage_download": "downloading telemetry…",
+        "stage_align": "aligning positions…",
+        "stage_ia": "classifying phases (AI)…",
+        "stage_energy": "computing energy…",
         "api_error": "API error ({endpoint}): {e}",
+        "no_telemetry": "The API returned no telemetry (car_data/location) for this lap.",
         "lap_spend": "Lap Deployment",
         "recovery": "Recovery",
         "net_balance": "Net Balance",
@@ -124,6 +236,61 @@ Con un MGU-K de **350 kW**, los 8.5 MJ permiten usar la potencia eléctrica máx
         "circuit_normal": "🏁 Normal — 8.5 MJ",
         "circuit_limited": "⚠️ Limited recovery — 8.0 MJ",
         "circuit_highspeed": "🚀 High speed — 5.0 MJ",
+        "segments_title": "Energy per Segment",
+        "agreement_title": "KMeans vs Thresholds Agreement",
+        "agreement_default": "Default thresholds",
+        "agreement_calibrated": "Calibrated on this lap",
+        "agreement_table": "Rows: KMeans · Columns: default thresholds (samples)",
+        "agreement_compute": "Compute agreement (KMeans + calibration)",
+        "calibrated_thresholds": "Calibrated thresholds",
+        "season_title": "Season Overview",
+        "season_empty": "No laps materialized yet. Laps are added automatically when you analyze them or load a session energy table with the default filters.",
+        "season_stored": "{laps} laps materialized across {circuits} circuits · queried in {ms:.0f} ms",
+        "season_db_error": "Last error while storing aggregates: {e}",
+        "season_drivers": "Drivers (per-lap average)",
+        "season_segments": "Clipping per circuit segment (per-lap average)",
+        "season_laps": "Materialized laps at this circuit",
+        "laps_count": "Laps",
+        "clipping_events": "Clipping onsets",
+        "v_clipping_onset": "Top speed at clipping onset (km/h)",
+        "straight": "Straight",
+        "corner": "Corner",
+        "segment": "Segment",
+        "dist_start": "Start (dist.)",
+        "dist_end": "End (dist.)",
+        "deploy_mj": "Deployment (MJ)",
+        "harvest_mj": "Harvesting (MJ)",
+        "clipping_s": "Clipping (s)",
+        "compare_title": "Comparison",
+        "compare_drivers": "Drivers to compare",
+        "compare_laps": "Laps to compare",
+        "compare_btn": "📈 Compare Laps",
+        "compare_ref": "Reference: {ref}",
+        "distance": "Distance",
+        "delta_time": "Δ Time (s)",
+        "delta_energy": "Δ Cum. energy (MJ)",
+        "speed_kmh": "Speed (km/h)",
+        "lap_energy_title": "⚡ Energy per Lap",
+        "lap_energy_progress": "Computing energy: {done}/{total} laps",
+        "lap_energy_error": "Could not compute session energy: {e}",
+        "lap_energy_failed": "Could not compute laps {laps}: {e}",
+        "lap": "Lap",
+        "lap_time": "Time",
+        "net_mj": "Net (MJ)",
+        "race_title": "Race",
+        "race_btn": "🔋 Simulate Race Battery (all drivers)",
+        "race_progress": "Processing laps for all drivers: {done}/{total}",
+        "race_soc": "SoC at end of each lap (MJ)",
+        "race_final_soc": "Final SoC (MJ)",
+        "race_starved_laps": "Laps out of battery",
+        "race_starved_s": "Time out of battery (s)",
+        "race_wasted": "Wasted harvest (MJ)",
+        "sweep_title": "🔬 Energy Model What-If Sweep",
+        "sweep_param": "Parameter (X axis)",
+        "sweep_param2": "Second parameter (optional)",
+        "sweep_range": "Range (× default value)",
+        "sweep_steps": "Steps per parameter",
+        "sweep_none": "—",
         "faq_title": "❓ Frequently Asked Questions & Methodology",
         "faq_content": """
 ### 📖 Operation Guide
@@ -166,15 +333,22 @@ With a **350 kW** MGU-K, 8.5 MJ allows maximum electric power for **~24 seconds*
         "menu_title": "🏁 Menu Principal",
         "go_to": "Ir para:",
         "analyzer": "📊 Analisador de Telemetria",
+        "season": "🗓️ Visão da Temporada",
         "faq": "❓ FAQ & Metodologia",
         "settings": "⚙️ Configuração",
         "year": "Ano",
         "sampling": "Amostragem (A cada N pontos)",
         "min_speed": "Velocidade Mínima",
+        "interpolate_pos": "Interpolar posições (mapa mais suave)",
+        "phase_engine": "Motor de fases",
+        "engine_kmeans": "KMeans (IA)",
+        "engine_thresholds": "Limiares (rápido)",
         "clear_data": "🗑️ Limpar Dados Salvos",
         "grand_prix": "Grande Prêmio",
         "session": "Sessão",
         "driver": "Piloto",
+        "index_loading": "Carregando o calendário da temporada…",
+        "drivers_pending": "A API ainda não publicou os pilotos desta sessão.",
         "language": "🌐 Idioma",
         "page_title": "🏎️ F1 IA: Analisador de Telemetria",
         "load_laps": "🚀 Carregar Histórico de Voltas",
@@ -182,7 +356,17 @@ With a **350 kW** MGU-K, 8.5 MJ allows maximum electric power for **~24 seconds*
         "select_lap": "Selecione a volta:",
         "analyze_lap": "📊 Analisar Volta Selecionada",
         "analyzing": "Analisando...",
+        "reloading_data": "Recarregando dados liberados da memória...",
+        "instrumentation": "📊 Instrumentação",
+        "mem_used": "Memória das sessões: {usado:.1f} / {total:.0f} MB",
+        "mem_stats": "Esta sessão: {propio:.1f} MB · {entradas} dados de {sesiones} sessões · {expulsiones} liberados · {recalculos} recalculados",
+        "stage_queued": "na fila…",
+        "stage_download": "baixando telemetria…",
+        "stage_align": "alinhando posições…",
+        "stage_ia": "classificando fases (IA)…",
+        "stage_energy": "calculando energia…",
         "api_error": "Erro na API ({endpoint}): {e}",
+        "no_telemetry": "A API não retornou telemetria (car_data/location) para esta volta.",
         "lap_spend": "Gasto na Volta",
         "recovery": "Recuperação",
         "net_balance": "Saldo Líquido",
@@ -197,6 +381,61 @@ With a **350 kW** MGU-K, 8.5 MJ allows maximum electric power for **~24 seconds*
         "circuit_normal": "🏁 Normal — 8,5 MJ",
         "circuit_limited": "⚠️ Recuperação limitada — 8,0 MJ",
         "circuit_highspeed": "🚀 Alta velocidade — 5,0 MJ",
+        "segments_title": "Energia por Segmento",
+        "agreement_title": "Concordância KMeans vs Limiares",
+        "agreement_default": "Limiares padrão",
+        "agreement_calibrated": "Calibrados nesta volta",
+        "agreement_table": "Linhas: KMeans · Colunas: limiares padrão (amostras)",
+        "agreement_compute": "Calcular concordância (KMeans + calibração)",
+        "calibrated_thresholds": "Limiares calibrados",
+        "season_title": "Resumo da Temporada",
+        "season_empty": "Ainda não há voltas materializadas. Elas são adicionadas ao analisar voltas ou carregar a tabela de energia de uma sessão com os filtros padrão.",
+        "season_stored": "{laps} voltas materializadas em {circuits} circuitos · consultas em {ms:.0f} ms",
+        "season_db_error": "Último erro ao salvar agregados: {e}",
+        "season_drivers": "Pilotos (média por volta)",
+        "season_segments": "Clipping por segmento do circuito (média por volta)",
+        "season_laps": "Voltas materializadas do circuito",
+        "laps_count": "Voltas",
+        "clipping_events": "Inícios de clipping",
+        "v_clipping_onset": "Vel. máx. ao iniciar clipping (km/h)",
+        "straight": "Reta",
+        "corner": "Curva",
+        "segment": "Segmento",
+        "dist_start": "Início (dist.)",
+        "dist_end": "Fim (dist.)",
+        "deploy_mj": "Deployment (MJ)",
+        "harvest_mj": "Harvesting (MJ)",
+        "clipping_s": "Clipping (s)",
+        "compare_title": "Comparação",
+        "compare_drivers": "Pilotos para comparar",
+        "compare_laps": "Voltas para comparar",
+        "compare_btn": "📈 Comparar Voltas",
+        "compare_ref": "Referência: {ref}",
+        "distance": "Distância",
+        "delta_time": "Δ Tempo (s)",
+        "delta_energy": "Δ Energia acum. (MJ)",
+        "speed_kmh": "Velocidade (km/h)",
+        "lap_energy_title": "⚡ Energia por Volta",
+        "lap_energy_progress": "Calculando energia: {done}/{total} voltas",
+        "lap_energy_error": "Não foi possível calcular a energia da sessão: {e}",
+        "lap_energy_failed": "Não foi possível calcular as voltas {laps}: {e}",
+        "lap": "Volta",
+        "lap_time": "Tempo",
+        "net_mj": "Saldo (MJ)",
+        "race_title": "Corrida",
+        "race_btn": "🔋 Simular Bateria na Corrida (todos os pilotos)",
+        "race_progress": "Processando voltas de todos os pilotos: {done}/{total}",
+        "race_soc": "SoC no fim de cada volta (MJ)",
+        "race_final_soc": "SoC final (MJ)",
+        "race_starved_laps": "Voltas sem bateria",
+        "race_starved_s": "Tempo sem bateria (s)",
+        "race_wasted": "Harvest perdido (MJ)",
+        "sweep_title": "🔬 Varredura What-If do Modelo de Energia",
+        "sweep_param": "Parâmetro (eixo X)",
+        "sweep_param2": "Segundo parâmetro (opcional)",
+        "sweep_range": "Faixa (× valor padrão)",
+        "sweep_steps": "Passos por parâmetro",
+        "sweep_none": "—",
         "faq_title": "❓ Perguntas Frequentes e Metodologia",
         "faq_content": """
 ### 📖 Guia de Operação
@@ -366,6 +605,196 @@ def get_data_api(endpoint, params=None):
         st.error(T["api_error"].format(endpoint=endpoint, e=e))
     return []
 
+# ─────────────────────────────────────────────
+#  DESCARGA POR VENTANAS
+#  Rangos date>/date< largos se parten en bloques
+#  alineados de duración fija: se bajan en paralelo,
+#  se reintentan y se cachean uno a uno.
+# ─────────────────────────────────────────────
+VENTANA_DESCARGA = pd.Timedelta(seconds=int(os.environ.get("F1_CHUNK_S", 300)))
+MAX_DESCARGAS_EN_PARALELO = 4   # OpenF1 limita peticiones por segundo
+REINTENTOS_API = 3
+MARGEN_BLOQUE_VIVO = pd.Timedelta(minutes=2)  # bloques más recientes pueden crecer: sin caché
+
+@st.cache_resource
+def pool_descargas():
+    """Pool propio: los bloques se piden desde tareas de pool_trabajos, que esperan por ellos."""
+    return ThreadPoolExecutor(max_workers=MAX_DESCARGAS_EN_PARALELO, thread_name_prefix="f1-descarga")
+
+class ErrorDescarga(Exception):
+    """La API no respondió tras los reintentos. No se cachea: el siguiente intento vuelve a pedir."""
+
+def pedir_api(endpoint, params):
+    """Como get_data_api pero reintenta con backoff y lanza ErrorDescarga si todo falla."""
+    url = requests.Request('GET', f"{BASE_URL}/{endpoint}", params=params).prepare().url
+    error = None
+    for intento in range(REINTENTOS_API):
+        if intento:
+            time.sleep(0.5 * 2 ** intento)
+        try:
+            r = requests.get(url, timeout=30)
+            if r.status_code == 200:
+                return r.json()
+            if r.status_code == 404:
+                return []   # OpenF1 responde 404 cuando la ventana no tiene muestras
+            error = RuntimeError(f"HTTP {r.status_code}")
+        except requests.RequestException as e:
+            error = e
+    raise ErrorDescarga(f"{endpoint}: {error}") from error
+
+def _bloque(endpoint, params, inicio, fin):
+    return pedir_api(endpoint, params | {"date>=": inicio.isoformat(), "date<": fin.isoformat()})
+
+@st.cache_data(max_entries=2048, show_spinner=False)
+def _bloque_cacheado(endpoint, params, inicio, fin):
+    return _bloque(endpoint, params, inicio, fin)
+
+def _fechas_filas(filas):
+    return pd.DatetimeIndex(pd.to_datetime([f['date'] for f in filas], format='mixed', utc=True))
+
+def descargar_por_ventanas(endpoint, params, desde, hasta, ventana=VENTANA_DESCARGA):
+    """
+    Filas de endpoint con desde < date < hasta (mismos límites que date>/date<).
+    Se piden los bloques [k·ventana, (k+1)·ventana) que cubren el rango, en
+    paralelo, y se recortan al rango. También una sola vuelta: cada bloque
+    terminado se cachea, así que sesión y vueltas vecinas reutilizan los mismos.
+    A diferencia de get_data_api, si algún bloque falla tras los reintentos
+    lanza ErrorDescarga: nunca devuelve una vuelta vacía o a medias que
+    acabaría cacheada como si fuera el resultado.
+    """
+    desde, hasta = pd.Timestamp(desde), pd.Timestamp(hasta)
+    inicios = pd.date_range(desde.floor(ventana), hasta, freq=ventana, inclusive='left')
+    vivo = pd.Timestamp.now(tz='UTC') - MARGEN_BLOQUE_VIVO
+    futuros = [
+        pool_descargas().submit(_bloque if ini + ventana > vivo else _bloque_cacheado,
+                                endpoint, params, ini, ini + ventana)
+        for ini in inicios
+    ]
+    bloques = [f.result() for f in futuros]
+
+    # Coser en orden: fuera duplicados en las fronteras y recorte al rango pedido.
+    # Un bloque interior que empieza después del anterior entra entero sin parsear.
+    filas, ultima = [], None
+    for ini, bloque in zip(inicios, bloques):
+        if not bloque:
+            continue
+        if desde < ini and ini + ventana < hasta and (ultima is None or pd.Timestamp(bloque[0]['date']) > ultima):
+            filas.extend(bloque)
+            ultima = pd.Timestamp(bloque[-1]['date'])
+            continue
+        fechas = _fechas_filas(bloque)
+        mascara = (fechas > desde) & (fechas < hasta)
+        if ultima is not None:
+            mascara &= fechas > ultima
+        filas.extend(f for f, ok in zip(bloque, mascara) if ok)
+        if mascara.any():
+            ultima = fechas[mascara].max()
+    return filas
+
+# ─────────────────────────────────────────────
+#  ALINEACIÓN car_data ↔ location
+#  Vecino más cercano sobre timestamps int64 (ns)
+#  con searchsorted, sin pasar por merge_asof.
+# ─────────────────────────────────────────────
+TOLERANCIA_POS_NS = 1_000_000_000  # 1 s, igual que el merge_asof original
+
+def fechas_ns(serie):
+    """Convierte una columna datetime (con o sin tz) a int64 en nanosegundos UTC."""
+    return pd.DatetimeIndex(serie).as_unit('ns').asi8
+
+def alinear_posiciones(t_car, t_loc, x_loc, y_loc, tolerancia_ns=TOLERANCIA_POS_NS, interpolar=False):
+    """
+    Devuelve (x, y) para cada timestamp de t_car tomando la muestra de location
+    más cercana dentro de la tolerancia (NaN si no hay ninguna).
+    Con interpolar=True interpola linealmente entre las dos muestras vecinas.
+    t_car debe venir ordenado; t_loc solo se ordena si no es monótono.
+    """
+    t_car = np.asarray(t_car, dtype=np.int64)
+    t_loc = np.asarray(t_loc, dtype=np.int64)
+    x_loc = np.asarray(x_loc, dtype=np.float64)
+    y_loc = np.asarray(y_loc, dtype=np.float64)
+    n = len(t_loc)
+    x_out = np.full(len(t_car), np.nan)
+    y_out = np.full(len(t_car), np.nan)
+    if n == 0 or len(t_car) == 0:
+        return x_out, y_out
+
+    if n > 1 and (np.diff(t_loc) < 0).any():
+        orden = np.argsort(t_loc, kind='stable')
+        t_loc, x_loc, y_loc = t_loc[orden], x_loc[orden], y_loc[orden]
+
+    # der = primera muestra estrictamente posterior, izq = última muestra <= t
+    der = np.searchsorted(t_loc, t_car, side='right')
+    izq = der - 1
+    hay_izq = izq >= 0
+    hay_der = der < n
+    izq_c = np.clip(izq, 0, n - 1)
+    der_c = np.clip(der, 0, n - 1)
+    d_izq = np.where(hay_izq, t_car - t_loc[izq_c], np.iinfo(np.int64).max)
+    d_der = np.where(hay_der, t_loc[der_c] - t_car, np.iinfo(np.int64).max)
+
+    # Empate → muestra anterior (mismo criterio que merge_asof 'nearest')
+    usar_izq = d_izq <= d_der
+    cercano = np.where(usar_izq, izq_c, der_c)
+    valido = np.minimum(d_izq, d_der) <= tolerancia_ns
+    x_out[valido] = x_loc[cercano[valido]]
+    y_out[valido] = y_loc[cercano[valido]]
+
+    if interpolar:
+        ambos = valido & hay_izq & hay_der
+        if ambos.any():
+            i0, i1 = izq_c[ambos], der_c[ambos]
+            w = d_izq[ambos] / (t_loc[i1] - t_loc[i0])
+            x_out[ambos] = x_loc[i0] + (x_loc[i1] - x_loc[i0]) * w
+            y_out[ambos] = y_loc[i0] + (y_loc[i1] - y_loc[i0]) * w
+    return x_out, y_out
+
+# Backend de construcción/parseo: "pandas" o "arrow" (columnas y fechas en C++)
+BACKEND_TELEMETRIA = os.environ.get("F1_BACKEND", "pandas")
+
+def _tabla_arrow(filas):
+    """Tabla Arrow desde las filas JSON con 'date' ya como timestamp UTC."""
+    tabla = pa.Table.from_pylist(filas)
+    i = tabla.schema.get_field_index('date')
+    return tabla.set_column(i, 'date', pc.cast(tabla['date'], pa.timestamp('us', 'UTC')))
+
+def _unir_car_location_arrow(c_raw, l_raw, interpolar=False):
+    """Misma salida que la ruta pandas de unir_car_location; parseo, orden y conversión en Arrow."""
+    tabla = _tabla_arrow(c_raw)
+    t_car = tabla['date'].to_numpy().astype('datetime64[ns]').view(np.int64)
+    if (np.diff(t_car) < 0).any():
+        orden = pc.sort_indices(tabla, sort_keys=[('date', 'ascending')])   # estable
+        tabla, t_car = tabla.take(orden), t_car[orden.to_numpy()]
+    loc = _tabla_arrow(l_raw)
+    x, y = alinear_posiciones(
+        t_car, loc['date'].to_numpy().astype('datetime64[ns]').view(np.int64),
+        loc['x'].to_numpy(zero_copy_only=False), loc['y'].to_numpy(zero_copy_only=False),
+        interpolar=interpolar,
+    )
+    df = tabla.to_pandas()
+    df['x'], df['y'] = x, y
+    return df
+
+def unir_car_location(c_raw, l_raw, interpolar=False):
+    """DataFrame de car_data ordenado por fecha con columnas x, y alineadas desde location."""
+    if BACKEND_TELEMETRIA == "arrow":
+        try:
+            return _unir_car_location_arrow(c_raw, l_raw, interpolar)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass    # fechas sin zona u otros formatos raros: la ruta pandas los acepta
+    df = pd.DataFrame(c_raw)
+    df['date'] = pd.to_datetime(df['date'], format='mixed')
+    if not df['date'].is_monotonic_increasing:
+        df = df.sort_values('date', kind='stable', ignore_index=True)
+    df_l = pd.DataFrame(l_raw, columns=['date', 'x', 'y'])
+    df['x'], df['y'] = alinear_posiciones(
+        fechas_ns(df['date']),
+        fechas_ns(pd.to_datetime(df_l['date'], format='mixed')),
+        df_l['x'].to_numpy(), df_l['y'].to_numpy(),
+        interpolar=interpolar,
+    )
+    return df
+
 # ─────────────────────────────────────────────
 #  MOTOR IA Y ENERGÍA
 #  Claves internas FIJAS (no traducidas) para
@@ -380,101 +809,1975 @@ def ia_label(key):
     """Devuelve el string traducido para mostrar en pantalla."""
     return T[key]
 
-def aplicar_ia_f1(df):
-    if len(df) < 10:
-        return df
-    df['accel'] = df['speed'].diff().fillna(0)
+# Motores de clasificación de fases, seleccionables por petición
+MOTOR_KMEANS   = "kmeans"
+MOTOR_UMBRALES = "thresholds"
+
+# Umbrales del clasificador determinista (calibrables con calibrar_umbrales):
+# recuperación si frena, levanta o decelera fuerte; deployment a fondo.
+UMBRALES_FASE = {
+    'throttle_deploy':  90,    # % acelerador a partir del cual hay deployment
+    'throttle_harvest': 10,    # % acelerador por debajo del cual se recupera
+    'brake_harvest':    1,     # freno (0/100 en OpenF1) que activa la recuperación
+    'accel_harvest':    -12,   # Δ velocidad por muestra (km/h) que cuenta como frenada
+}
+
+def clasificar_umbrales(throttle, brake, accel, umbrales=UMBRALES_FASE):
+    """
+    Fase por umbrales, vectorizada y en una pasada, sin ajuste de modelo.
+    Los umbrales pueden ser arrays (G, 1) para evaluar G candidatos a la vez.
+    """
+    u = umbrales
+    harvest = (brake >= u['brake_harvest']) | (throttle <= u['throttle_harvest']) | (accel <= u['accel_harvest'])
+    return np.select([harvest, throttle >= u['throttle_deploy']], [IA_HARVESTING, IA_DEPLOYMENT], IA_NEUTRAL)
+
+def _fases_kmeans(df):
     features = ['speed', 'throttle', 'brake', 'accel']
     scaler = StandardScaler()
     data_scaled = scaler.fit_transform(df[features].fillna(0))
     model = KMeans(n_clusters=3, random_state=42, n_init=10)
     df['cluster'] = model.fit_predict(data_scaled)
     c_means = df.groupby('cluster')['throttle'].mean().sort_values()
-    # ia_status_key: clave interna fija
     mapping = {
         c_means.index[0]: IA_HARVESTING,
         c_means.index[1]: IA_NEUTRAL,
         c_means.index[2]: IA_DEPLOYMENT,
     }
-    df['ia_status_key'] = df['cluster'].map(mapping)
+    return df['cluster'].map(mapping)
+
+def _columnas_umbrales(df):
+    return df['throttle'].fillna(0).to_numpy(), df['brake'].fillna(0).to_numpy(), df['accel'].to_numpy()
+
+def aplicar_ia_f1(df, motor=MOTOR_KMEANS, umbrales=UMBRALES_FASE):
+    if len(df) < 10:
+        return df
+    df['accel'] = df['speed'].diff().fillna(0)
+    # ia_status_key: clave interna fija
+    if motor == MOTOR_UMBRALES:
+        df['ia_status_key'] = clasificar_umbrales(*_columnas_umbrales(df), umbrales)
+    else:
+        df['ia_status_key'] = _fases_kmeans(df)
     clipping_mask = (df['throttle'] > 95) & (df['accel'] <= 0) & (df['speed'] > 250)
     df.loc[clipping_mask, 'ia_status_key'] = IA_CLIPPING
-    # ia_status: string traducido solo para mostrar
-    df['ia_status'] = df['ia_status_key'].map(ia_label)
+    # Solo la clave fija: el resultado se cachea y comparte entre usuarios e
+    # idiomas, así que la etiqueta se traduce al dibujar (ia_label)
     return df
 
+def calibrar_umbrales(vueltas, rondas=3):
+    """
+    Ajusta UMBRALES_FASE a las etiquetas KMeans de vueltas de referencia
+    (DataFrames ya pasados por aplicar_ia_f1 con MOTOR_KMEANS). Búsqueda por
+    coordenadas: cada umbral se barre sobre su rejilla con los demás fijos.
+    El clipping se ignora porque ambos motores lo marcan con la misma regla.
+    """
+    df = pd.concat(vueltas, ignore_index=True)
+    df = df[df['ia_status_key'] != IA_CLIPPING]
+    throttle, brake, accel = _columnas_umbrales(df)
+    ref = df['ia_status_key'].to_numpy()
+    rejillas = {
+        'throttle_deploy':  np.arange(50, 101),
+        'throttle_harvest': np.arange(0, 51),
+        'brake_harvest':    np.array([1, 10, 50, 100, 101]),     # 101 = sin regla de freno
+        'accel_harvest':    np.r_[-np.inf, np.quantile(accel, np.linspace(0, 0.3, 31))],
+    }
+    mejor = dict(UMBRALES_FASE)
+    for _ in range(rondas):
+        for nombre, rejilla in rejillas.items():
+            candidatos = mejor | {nombre: rejilla[:, None]}
+            acierto = (clasificar_umbrales(throttle, brake, accel, candidatos) == ref).mean(axis=1)
+            mejor[nombre] = rejilla[int(np.argmax(acierto))].item()
+    return mejor
+
+def informe_concordancia(df, umbrales=UMBRALES_FASE):
+    """
+    Concordancia del clasificador por umbrales con las etiquetas KMeans de df:
+    acierto global y tabla cruzada (filas KMeans, columnas umbrales).
+    """
+    ref = df['ia_status_key']
+    pred = pd.Series(clasificar_umbrales(*_columnas_umbrales(df), umbrales), index=df.index)
+    pred[ref == IA_CLIPPING] = IA_CLIPPING
+    orden = [IA_HARVESTING, IA_NEUTRAL, IA_DEPLOYMENT, IA_CLIPPING]
+    return {
+        'acierto': float((pred == ref).mean()),
+        'tabla': pd.crosstab(pd.Categorical(ref, orden), pd.Categorical(pred, orden), dropna=False),
+    }
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def concordancia_vuelta(df):
+    """Informe KMeans vs umbrales (por defecto y calibrados en la propia vuelta)."""
+    ref = aplicar_ia_f1(df[['speed', 'throttle', 'brake']].copy(), MOTOR_KMEANS)
+    calibrados = calibrar_umbrales([ref])
+    return {
+        'defecto': informe_concordancia(ref),
+        'calibrados': calibrados,
+        'calibrado': informe_concordancia(ref, calibrados),
+    }
+
+
+# Constantes físicas del modelo 2026 (valores por defecto del barrido what-if)
+PARAMS_ENERGIA_2026 = {
+    'masa': 800.0,                   # kg (peso mínimo reglamentario ~798 kg con piloto)
+    'ef_mgu_k': 0.75,                # Eficiencia de conversión del MGU-K (~70-80%)
+    'p_max_deployment': 350000.0,    # W
+    'p_max_harvesting': 350000.0,    # W (límite de potencia regenerativa)
+    'v_derating': 290.0,             # km/h a partir de la cual cae la potencia eléctrica
+    'rango_derating': 100.0,         # km/h para perder el 100% (antes del suelo)
+    'factor_min_derating': 0.3,      # suelo del derating
+    'brake_umbral': 5.0,             # % de freno a partir del cual es frenada activa
+    'brake_div_regen': 150.0,        # regen = 1 - brake / brake_div_regen
+    'regen_min': 0.2,                # regen con freno muy alto (mecánicos disipan mucho)
+    'regen_coast': 0.3,              # regen sin freno (lift & coast)
+    'energy_limit_mj': 8.5,          # límite por vuelta (8.5 / 8.0 / 5.0 MJ)
+}
+POTENCIA_ULTIMO_PUNTO = -40000  # W, harvesting en el último punto (sin velocidad siguiente)
+
+def potencia_2026(speed, throttle, brake, dt, key, params=PARAMS_ENERGIA_2026, fin=None):
+    """
+    Potencia eléctrica (W) por muestra. Los parámetros pueden ser escalares o
+    arrays (P, 1): el resultado se difunde a (P, N), una fila por combinación.
+    fin marca la última muestra de cada vuelta (por defecto, la última).
+    """
+    p = {k: np.asarray(params.get(k, v), dtype=np.float64) for k, v in PARAMS_ENERGIA_2026.items()}
+    speed = np.asarray(speed, dtype=np.float64)
+    throttle = np.asarray(throttle, dtype=np.float64)
+    brake = np.asarray(brake, dtype=np.float64)
+    dt = np.asarray(dt, dtype=np.float64)
+    if fin is None:
+        fin = np.zeros(len(speed), dtype=bool)
+        fin[-1:] = True
+
+    # ── DEPLOYMENT: derating por encima de v_derating ──────
+    factor = np.where(
+        speed > p['v_derating'],
+        np.maximum(p['factor_min_derating'], 1 - (speed - p['v_derating']) / p['rango_derating']),
+        1.0,
+    )
+    p_deploy = p['p_max_deployment'] * factor * (throttle / 100)
+
+    # ── HARVESTING: ΔE_cinética = 0.5 * m * (v1² - v2²) ───
+    v_ms = speed / 3.6  # km/h -> m/s
+    v_next = np.r_[v_ms[1:], v_ms[-1:]]
+    delta_E_k = 0.5 * p['masa'] * (v_ms ** 2 - v_next ** 2)
+    # Factor de regeneración: a más freno, más va a mecánicos;
+    # sin freno activo, lift & coast recupera menos
+    brake_pct = np.minimum(brake, 100)
+    regen_factor = np.where(
+        brake_pct > p['brake_umbral'],
+        np.maximum(p['regen_min'], 1 - brake_pct / p['brake_div_regen']),
+        p['regen_coast'],
+    )
+    E_recuperable = delta_E_k * p['ef_mgu_k'] * regen_factor
+    # Potencia = Energía / tiempo, limitada a p_max_harvesting
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_harvest = np.where(dt > 0, -np.minimum(E_recuperable / np.where(dt > 0, dt, 1), p['p_max_harvesting']), 0.0)
+    p_harvest = np.where(fin, POTENCIA_ULTIMO_PUNTO, p_harvest)
 
-def calcular_energia_2026(df):
+    # CLIPPING y NEUTRAL no aportan potencia
+    return np.where(key == IA_DEPLOYMENT, p_deploy, np.where(key == IA_HARVESTING, p_harvest, 0.0))
+
+def calcular_energia_2026(df, params=PARAMS_ENERGIA_2026):
     # Cap dt a 0.5s — gaps mayores son pausas de telemetría, no tiempo real de motor
     df['dt'] = df['date'].diff().dt.total_seconds().fillna(0).clip(upper=0.12)
-    df['racha_id'] = (df['ia_status_key'] != df['ia_status_key'].shift()).cumsum()
-    
-    # Constantes físicas
-    MASA_F1 = 800  # kg (peso mínimo reglamentario ~798 kg con piloto)
-    EF_MGU_K = 0.75  # Eficiencia de conversión del MGU-K (~70-80%)
-    P_MAX_DEPLOYMENT = 350000  # W
-    P_MAX_HARVESTING = 350000  # W (límite de potencia regenerativa)
-
-    def estimar_potencia(row, idx):
-        v, key = row['speed'], row['ia_status_key']
-        
-        # ── DEPLOYMENT ──────────────────────────────────
-        if key == IA_DEPLOYMENT:
-            p_max = P_MAX_DEPLOYMENT
-            # Derating por encima de 290 km/h
-            if v > 290:
-                factor = max(0.3, 1 - (v - 290) / 100)
-                p_max *= factor
-            return p_max * (row['throttle'] / 100)
-        
-        # ── CLIPPING  ──────────────────────────────
-        elif key == IA_CLIPPING:
-            return 0
-        
-        # ── HARVESTING ───────────────────────────
-        elif key == IA_HARVESTING:
-            # Obtener velocidad siguiente para calcular ΔE_cinética
-            if idx < len(df) - 1:
-                v_actual = row['speed'] / 3.6  # km/h -> m/s
-                v_next = df.iloc[idx + 1]['speed'] / 3.6
-                dt = row['dt']
-                
-                # ΔE_cinética = 0.5 * m * (v1² - v2²)
-                delta_E_k = 0.5 * MASA_F1 * (v_actual**2 - v_next**2)
-                
-                # Factor de regeneración: a más freno, más va a mecánicos
-                # Con brake bajo el MGU-K captura casi todo
-                # Con brake alto (>80%) los frenos mecánicos disipan mucho
-                brake_pct = min(row['brake'], 100)
-                if brake_pct > 5:
-                    # Curva: 90% regen con brake bajo, 20% con brake muy alto
-                    regen_factor = max(0.2, 1 - brake_pct / 150)
-                else:
-                    # Sin freno activo, lift & coast recupera menos
-                    regen_factor = 0.3
-                
-                # Energía recuperable = ΔE_k * eficiencia * factor_regen
-                E_recuperable = delta_E_k * EF_MGU_K * regen_factor
-                
-                # Potencia = Energía / tiempo, limitada a 350 kW
-                if dt > 0:
-                    potencia = -min(E_recuperable / dt, P_MAX_HARVESTING)
-                else:
-                    potencia = 0
-                
-                return potencia
-            else:
-                # Último punto, asumir potencia mínima
-                return -40000
-        
-        # ── NEUTRAL ─────────────────────────────────────────────
-        return 0
-
-    # Aplicar cálculo punto por punto con índice
-    df['power_w'] = [estimar_potencia(row, idx) for idx, row in df.iterrows()]
+    df['power_w'] = potencia_2026(
+        df['speed'].to_numpy(), df['throttle'].to_numpy(), df['brake'].to_numpy(),
+        df['dt'].to_numpy(), df['ia_status_key'].to_numpy(), params,
+    )
     df['energy_j'] = df['power_w'] * df['dt']
     return df
 
+# ─────────────────────────────────────────────
+#  SEGMENTOS DE FASE (run-length)
+#  Una fila por racha consecutiva del mismo
+#  ia_status_key, calculada en una sola pasada.
+# ─────────────────────────────────────────────
+def segmentos_fase(df):
+    """
+    Tabla run-length de fases: inicio/fin (posiciones, fin incluido), status,
+    duración (s), energía (J) y, si la vuelta tiene 'dist', distancia de
+    inicio/fin.
+    """
+    key = df['ia_status_key'].to_numpy()
+    n = len(key)
+    if n == 0:
+        return pd.DataFrame(columns=['inicio', 'fin', 'status', 'duracion_s', 'energia_j'])
+    inicio = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    fin = np.r_[inicio[1:], n] - 1
+    seg = pd.DataFrame({
+        'inicio': inicio.astype(np.int32),
+        'fin': fin.astype(np.int32),
+        'status': pd.Categorical(key[inicio], categories=[IA_HARVESTING, IA_NEUTRAL, IA_DEPLOYMENT, IA_CLIPPING]),
+        'duracion_s': np.add.reduceat(df['dt'].to_numpy(), inicio).astype(np.float32),
+        'energia_j': np.add.reduceat(df['energy_j'].to_numpy(), inicio),
+    })
+    if 'dist' in df.columns:
+        dist = df['dist'].to_numpy()
+        seg['dist_inicio'] = dist[inicio].astype(np.float32)
+        seg['dist_fin'] = dist[fin].astype(np.float32)
+    return seg
+
+def indices_trazo(seg, n):
+    """
+    Índices de muestra para dibujar los segmentos como líneas: cada segmento
+    incluye el primer punto del siguiente (sin huecos) y termina en -1 (corte).
+    """
+    ini = seg['inicio'].to_numpy(np.int64)
+    fin = np.minimum(seg['fin'].to_numpy(np.int64) + 1, n - 1)
+    largos = fin - ini + 2
+    pos = np.r_[0, np.cumsum(largos)[:-1]]
+    idx = np.arange(largos.sum()) - np.repeat(pos, largos) + np.repeat(ini, largos)
+    idx[pos + largos - 1] = -1
+    return idx
+
+# ─────────────────────────────────────────────
+#  BARRIDO WHAT-IF DEL MODELO DE ENERGÍA
+#  Todas las combinaciones contra todas las vueltas
+#  en una sola operación difundida (P × N).
+# ─────────────────────────────────────────────
+def rejilla_parametros(**rangos):
+    """
+    Producto cartesiano de los valores dados por parámetro, p. ej.
+    rejilla_parametros(masa=[780, 800], energy_limit_mj=[8.5, 8.0, 5.0]).
+    Los parámetros no indicados toman su valor por defecto.
+    """
+    desconocidos = set(rangos) - set(PARAMS_ENERGIA_2026)
+    if desconocidos:
+        raise KeyError(f"Parámetros desconocidos: {sorted(desconocidos)}")
+    idx = pd.MultiIndex.from_product([np.asarray(v, dtype=float) for v in rangos.values()],
+                                     names=list(rangos))
+    rejilla = idx.to_frame(index=False)
+    for k, v in PARAMS_ENERGIA_2026.items():
+        if k not in rejilla:
+            rejilla[k] = v
+    return rejilla
+
+def barrido_parametros(vueltas, rejilla, bloque=256):
+    """
+    Evalúa cada fila de la rejilla contra cada vuelta (dict etiqueta → df con
+    speed, throttle, brake, dt e ia_status_key). Devuelve una tabla tidy con
+    una fila por (combinación, vuelta): deploy, harvest, balance neto y exceso
+    sobre el límite, en MJ. Las combinaciones se procesan en bloques para
+    acotar la memoria de la matriz (bloque × N).
+    """
+    etiquetas = list(vueltas)
+    dfs = [vueltas[k] for k in etiquetas]
+    largos = np.array([len(d) for d in dfs])
+    inicios = np.r_[0, np.cumsum(largos)[:-1]]
+    col = lambda c: np.concatenate([d[c].to_numpy() for d in dfs])
+    speed, throttle, brake, dt, key = col('speed'), col('throttle'), col('brake'), col('dt'), col('ia_status_key')
+    fin = np.zeros(len(speed), dtype=bool)
+    fin[inicios + largos - 1] = True
+    es_dep = key == IA_DEPLOYMENT
+    es_hrv = key == IA_HARVESTING
+
+    resultados = []
+    for b0 in range(0, len(rejilla), bloque):
+        sub = rejilla.iloc[b0:b0 + bloque]
+        params = {k: sub[k].to_numpy()[:, None] for k in PARAMS_ENERGIA_2026}
+        energia = potencia_2026(speed, throttle, brake, dt, key, params, fin=fin) * dt
+        deploy = np.add.reduceat(np.where(es_dep, energia, 0.0), inicios, axis=1) / 1e6
+        harvest = -np.add.reduceat(np.where(es_hrv, energia, 0.0), inicios, axis=1) / 1e6
+        resultados.append((deploy, harvest))
+
+    deploy = np.vstack([r[0] for r in resultados])
+    harvest = np.vstack([r[1] for r in resultados])
+    P, K = deploy.shape
+    tabla = rejilla.loc[rejilla.index.repeat(K)].reset_index(drop=True)
+    tabla.insert(0, 'combinacion', np.repeat(np.arange(P), K))
+    tabla.insert(1, 'vuelta', np.tile(etiquetas, P))
+    tabla['deploy_mj'] = deploy.ravel()
+    tabla['harvest_mj'] = harvest.ravel()
+    tabla['net_mj'] = tabla['deploy_mj'] - tabla['harvest_mj']
+    tabla['exceso_mj'] = np.maximum(tabla['deploy_mj'] - tabla['energy_limit_mj'], 0)
+    return tabla
+
+# ─────────────────────────────────────────────
+#  PISTA DE REFERENCIA Y SEGMENTOS
+#  Trazado por circuito (meeting_key) con distancia
+#  acumulada, índice KD-tree y curvas/rectas.
+# ─────────────────────────────────────────────
+SEG_RECTA = "straight"
+SEG_CURVA = "corner"
+
+class PistaReferencia:
+    """Trazado remuestreado a paso de distancia constante con índice espacial."""
+
+    N_PUNTOS = 2000           # puntos del trazado remuestreado
+    VENTANA_CURVA = 0.01      # fracción de vuelta para medir el cambio de rumbo
+    UMBRAL_CURVA = 0.15       # rad de giro dentro de la ventana para considerar curva
+    MIN_SEGMENTO = 0.015      # fracción de vuelta mínima de un segmento
+
+    def __init__(self, x, y):
+        pts = np.column_stack([np.asarray(x, float), np.asarray(y, float)])
+        pts = pts[~np.isnan(pts).any(axis=1)]
+        # Quitar puntos repetidos consecutivos (coche parado o muestras duplicadas)
+        pts = pts[np.r_[True, (np.diff(pts, axis=0) != 0).any(axis=1)]]
+        d = np.r_[0.0, np.cumsum(np.hypot(*np.diff(pts, axis=0).T))]
+        self.longitud = float(d[-1])
+        self.distancia = np.linspace(0.0, self.longitud, self.N_PUNTOS)
+        self.x = np.interp(self.distancia, d, pts[:, 0])
+        self.y = np.interp(self.distancia, d, pts[:, 1])
+        self.arbol = KDTree(np.column_stack([self.x, self.y]))
+        self.segmentos = self._detectar_segmentos()
+
+    def _detectar_segmentos(self):
+        # Suavizado circular (la vuelta es cerrada) para filtrar el ruido de location
+        w = max(int(self.N_PUNTOS * self.VENTANA_CURVA) // 2, 1)
+        kernel = np.ones(2 * w + 1) / (2 * w + 1)
+        xs = np.convolve(np.r_[self.x[-w:], self.x, self.x[:w]], kernel, 'valid')
+        ys = np.convolve(np.r_[self.y[-w:], self.y, self.y[:w]], kernel, 'valid')
+        # Giro de rumbo dentro de una ventana centrada, envuelto a [-π, π]
+        rumbo = np.arctan2(np.gradient(ys), np.gradient(xs))
+        giro = np.abs(np.angle(np.exp(1j * (np.roll(rumbo, -w) - np.roll(rumbo, w)))))
+        es_curva = giro > self.UMBRAL_CURVA
+
+        # Absorber tramos demasiado cortos en el segmento vecino
+        min_pts = int(self.N_PUNTOS * self.MIN_SEGMENTO)
+        cambios = np.flatnonzero(np.diff(es_curva.astype(np.int8))) + 1
+        inicios = np.r_[0, cambios]
+        fines = np.r_[cambios, self.N_PUNTOS]
+        for i0, i1 in zip(inicios, fines):
+            if i1 - i0 < min_pts:
+                if i0 > 0:
+                    es_curva[i0:i1] = es_curva[i0 - 1]
+                elif i1 < self.N_PUNTOS:
+                    es_curva[i0:i1] = es_curva[i1]
+
+        cambios = np.flatnonzero(np.diff(es_curva.astype(np.int8))) + 1
+        inicios = np.r_[0, cambios]
+        fines = np.r_[cambios, self.N_PUNTOS] - 1
+        tipos = np.where(es_curva[inicios], SEG_CURVA, SEG_RECTA)
+        seg = pd.DataFrame({
+            'segmento_id': np.arange(len(inicios)),
+            'tipo': tipos,
+            'dist_inicio': self.distancia[inicios],
+            'dist_fin': self.distancia[fines],
+        })
+        # Numeración por tipo: Curva 1, Curva 2… / Recta 1, Recta 2…
+        seg['numero'] = seg.groupby('tipo').cumcount() + 1
+        return seg
+
+    def proyectar(self, x, y):
+        """Distancia a lo largo de la vuelta del punto del trazado más cercano a cada (x, y)."""
+        _, idx = self.arbol.query(np.column_stack([x, y]), k=1)
+        dist = self.distancia[idx[:, 0]]
+        # La vuelta empieza y termina en la línea: corregir el salto 0 ↔ longitud
+        n = len(dist)
+        pos = np.arange(n)
+        dist = np.where((pos < n // 4) & (dist > 0.75 * self.longitud), dist - self.longitud, dist)
+        dist = np.where((pos > 3 * n // 4) & (dist < 0.25 * self.longitud), dist + self.longitud, dist)
+        return dist
+
+    def segmento_de(self, dist):
+        """segmento_id para cada distancia (fuera de rango se asigna al primero/último)."""
+        idx = np.searchsorted(self.segmentos['dist_inicio'].to_numpy(), dist, side='right') - 1
+        return np.clip(idx, 0, len(self.segmentos) - 1)
+
+MIN_PUNTOS_PISTA = 100    # posiciones mínimas de una vuelta para trazar el circuito
+
+@st.cache_resource
+def pistas_referencia():
+    """meeting_key -> (PistaReferencia, duración de la vuelta que la trazó)."""
+    return {}
+
+def pista_referencia(meeting_key, x, y, lap_duration=None):
+    """
+    Trazado de referencia del circuito. La vuelta más rápida analizada hasta
+    ahora sustituye a la anterior: así la referencia acaba siendo una vuelta
+    lanzada limpia y no la primera que llegó (de salida, de boxes…).
+    Sin lap_duration solo se consulta (o se traza si aún no hay ninguna).
+    None si no hay referencia y la vuelta no trae posiciones suficientes.
+    """
+    pistas = pistas_referencia()
+    actual = pistas.get(meeting_key)
+    mejora = lap_duration is not None and (actual is None or actual[1] is None or lap_duration < actual[1])
+    if (actual is None or mejora) and len(x) >= MIN_PUNTOS_PISTA:
+        pista = PistaReferencia(x, y)
+        pista.version = uuid.uuid4().hex    # entra en las claves de caché derivadas del trazado
+        actual = (pista, lap_duration)
+        pistas[meeting_key] = actual
+    return None if actual is None else actual[0]
+
+def asignar_distancia(df, pista):
+    """Añade 'dist' (distancia a lo largo de la vuelta) y 'segmento_id' a la telemetría."""
+    df['dist'] = pista.proyectar(df['x'].to_numpy(), df['y'].to_numpy())
+    df['segmento_id'] = pista.segmento_de(df['dist'].to_numpy())
+    return df
+
+def energia_por_segmento(df, pista):
+    """Deployment, harvesting y clipping agregados por segmento de pista."""
+    key = df['ia_status_key']
+    agg = pd.DataFrame({
+        # Reproyectada sobre la pista actual: la 'dist' de una vuelta cacheada
+        # puede venir de un trazado ya sustituido
+        'segmento_id': pista.segmento_de(pista.proyectar(df['x'].to_numpy(), df['y'].to_numpy())),
+        'deploy_mj': df['energy_j'].where(key == IA_DEPLOYMENT, 0) / 1e6,
+        'harvest_mj': -df['energy_j'].where(key == IA_HARVESTING, 0) / 1e6,
+        'clipping_s': df['dt'].where(key == IA_CLIPPING, 0),
+    }).groupby('segmento_id').sum()
+    return pista.segmentos.join(agg, on='segmento_id').fillna(0)
+
+# ─────────────────────────────────────────────
+#  TRABAJOS EN SEGUNDO PLANO
+#  El pool vive en cache_resource y el handle en
+#  session_state: un rerun no mata el trabajo.
+# ─────────────────────────────────────────────
+ETAPA_COLA      = "stage_queued"
+ETAPA_DESCARGA  = "stage_download"
+ETAPA_ALINEAR   = "stage_align"
+ETAPA_IA        = "stage_ia"
+ETAPA_ENERGIA   = "stage_energy"
+
+@st.cache_resource
+def pool_trabajos():
+    """Pool de hilos compartido por todas las sesiones del servidor."""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="f1-worker")
+
+class TrabajoCancelado(Exception):
+    pass
+
+class Trabajo:
+    """
+    Handle de un trabajo enviado al pool: etapa y progreso actuales,
+    cancelación cooperativa (se comprueba al cambiar de etapa) y resultado.
+    fn recibe el handle como argumento 'trabajo'.
+    """
+
+    def __init__(self, fn, *args, meta=None, **kwargs):
+        self.meta = meta or {}
+        self.etapa = ETAPA_COLA
+        self.progreso = 0.0
+        self._cancelar = threading.Event()
+        self.future = pool_trabajos().submit(fn, *args, trabajo=self, **kwargs)
+
+    def avanzar(self, etapa, progreso):
+        if self._cancelar.is_set():
+            raise TrabajoCancelado()
+        self.etapa, self.progreso = etapa, progreso
+
+    def cancelar(self):
+        self._cancelar.set()
+        self.future.cancel()
+
+    @property
+    def cancelado(self):
+        return self._cancelar.is_set()
+
+    @property
+    def terminado(self):
+        return self.future.done()
+
+    @property
+    def error(self):
+        """Excepción del trabajo (None si terminó bien o se canceló)."""
+        if self.future.cancelled():
+            return None
+        e = self.future.exception()
+        return None if isinstance(e, TrabajoCancelado) else e
+
+    def resultado(self):
+        """Resultado del trabajo; None si se canceló o falló."""
+        if self.future.cancelled() or self.future.exception() is not None:
+            return None
+        return self.future.result()
+
+def _avanzar(trabajo, etapa, progreso):
+    if trabajo is not None:
+        trabajo.avanzar(etapa, progreso)
+
+def sondear(fn, clave, run_every):
+    """
+    Ejecuta fn(en_linea) como fragmento repetido cada run_every segundos.
+    en_linea es True solo en la pasada dentro del rerun completo: ahí un
+    st.rerun() descartaría los clics de esa pasada, así que fn solo debe
+    pedirlo desde las repeticiones del fragmento.
+    """
+    st.session_state[clave] = True
+
+    def _fragmento():
+        fn(st.session_state.pop(clave, False))
+
+    st.fragment(_fragmento, run_every=run_every)()
+
+# ─────────────────────────────────────────────
+#  PIPELINE POR VUELTA (cacheado)
+# ─────────────────────────────────────────────
+class SinTelemetria(Exception):
+    """La API aún no trae muestras de la vuelta. No se cachea: pueden publicarse más tarde."""
+
+def vuelta_en_vivo(t_start, lap_duration):
+    """La vuelta acaba dentro de MARGEN_BLOQUE_VIVO: sus muestras aún pueden crecer."""
+    fin = pd.Timestamp(t_start) + pd.Timedelta(seconds=lap_duration + 0.8)
+    return fin > pd.Timestamp.now(tz='UTC') - MARGEN_BLOQUE_VIVO
+
+def _vuelta(session_key, driver_number, meeting_key, t_start, lap_duration,
+            v_min, muestreo, interpolar, motor, _trabajo=None):
+    _avanzar(_trabajo, ETAPA_DESCARGA, 0.05)
+    t_end = t_start + pd.Timedelta(seconds=lap_duration + 0.8)
+    params = {"session_key": session_key, "driver_number": driver_number}
+    c_raw = descargar_por_ventanas("car_data", params, t_start, t_end)
+    l_raw = descargar_por_ventanas("location", params, t_start, t_end)
+    if not (c_raw and l_raw):
+        raise SinTelemetria()
+    _avanzar(_trabajo, ETAPA_ALINEAR, 0.45)
+    df = unir_car_location(c_raw, l_raw, interpolar=interpolar)
+    # Trazado de referencia con la vuelta completa (antes de filtrar/muestrear)
+    df_xy = df.dropna(subset=['x', 'y'])
+    pista = pista_referencia(meeting_key, df_xy['x'].to_numpy(), df_xy['y'].to_numpy(), lap_duration)
+    if pista is None:
+        raise SinTelemetria()
+    if v_min > 0:
+        df = df[df['speed'] >= v_min]
+    if muestreo > 1:
+        df = df.iloc[::muestreo]
+    _avanzar(_trabajo, ETAPA_IA, 0.6)
+    df = aplicar_ia_f1(df.dropna(subset=['x', 'y']), motor)
+    _avanzar(_trabajo, ETAPA_ENERGIA, 0.85)
+    return calcular_energia_2026(df).pipe(asignar_distancia, pista)
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _vuelta_cacheada(session_key, driver_number, meeting_key, t_start, lap_duration,
+                     v_min, muestreo, interpolar, motor, _trabajo=None):
+    """Antes de calcular mira el almacén: otro proceso o el vigilante pueden haberla dejado ahí."""
+    args = (session_key, driver_number, meeting_key, t_start, lap_duration, v_min, muestreo, interpolar, motor)
+    tabla = leer_almacen(args)
+    if tabla is not None:
+        return tabla.to_pandas()
+    df = _vuelta(*args, _trabajo)
+    escribir_almacen(pa.Table.from_pandas(df), args)
+    return df
+
+def analizar_vuelta(session_key, driver_number, meeting_key, t_start, lap_duration,
+                    v_min=0, muestreo=1, interpolar=False, motor=MOTOR_KMEANS, _trabajo=None):
+    """
+    Descarga + alineación + IA + energía + distancia de una vuelta.
+    Devuelve None si la API aún no trae datos y lanza ErrorDescarga si falla;
+    ninguno de los dos casos se cachea, así que la vuelta se vuelve a pedir.
+    El resto se cachea por parámetros (análisis o comparación no repiten
+    trabajo), salvo una vuelta en vivo: sus muestras aún pueden crecer.
+    _trabajo (fuera del hash) recibe el progreso por etapas.
+    """
+    fn = _vuelta if vuelta_en_vivo(t_start, lap_duration) else _vuelta_cacheada
+    try:
+        return fn(session_key, driver_number, meeting_key, t_start, lap_duration,
+                  v_min, muestreo, interpolar, motor, _trabajo)
+    except SinTelemetria:
+        return None
+
+def trabajo_analisis(*args, trabajo):
+    """Punto de entrada de Trabajo para analizar_vuelta; materializa la vuelta si no hay filtros."""
+    df = analizar_vuelta(*args, _trabajo=trabajo)
+    session_key, driver_number, meeting_key, _, _, v_min, muestreo, interpolar, motor = args
+    if df is not None and es_filtro_por_defecto(v_min, muestreo, interpolar):
+        pista = pista_referencia(meeting_key, df['x'].to_numpy(), df['y'].to_numpy())
+        if pista is not None:
+            materializar_vuelta(meeting_key, session_key, driver_number, trabajo.meta['vuelta'][2],
+                                motor, df, pista)
+    return df
+
+# ─────────────────────────────────────────────
+#  ALMACÉN DE TELEMETRÍA
+#  Con F1_STORAGE=mmap cada vuelta analizada se
+#  escribe una vez en un fichero Arrow IPC que
+#  cualquier proceso del servidor mapea sin copiar;
+#  session_state solo guarda una vista (la ruta).
+#  En ambos modos el mismo directorio guarda las
+#  vueltas y tablas terminadas (caché entre procesos).
+# ─────────────────────────────────────────────
+MODO_ALMACEN = os.environ.get("F1_STORAGE", "memory")     # "memory" | "mmap"
+DIR_ALMACEN  = os.environ.get("F1_STORAGE_DIR", os.path.join(tempfile.gettempdir(), "f1-explained"))
+TTL_ALMACEN_S = 24 * 3600
+VERSION_ALMACEN = 2     # subirla si cambian las columnas calculadas
+
+class VistaTelemetria:
+    """Referencia ligera a una vuelta guardada en el almacén mapeado."""
+
+    def __init__(self, ruta, filas):
+        self.ruta = ruta
+        self.filas = filas
+
+    def __len__(self):
+        return self.filas
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def _telemetria_mapeada(ruta):
+    """
+    DataFrame sobre el fichero mapeado, uno por proceso y fichero. Las
+    columnas numéricas apuntan directamente a las páginas del mapa (solo
+    lectura), así que todas las sesiones comparten la misma memoria.
+    """
+    tabla = pa_ipc.open_file(pa.memory_map(ruta)).read_all()
+    return tabla.to_pandas(split_blocks=True)
+
+def _purgar_almacen():
+    limite = time.time() - TTL_ALMACEN_S
+    for nombre in os.listdir(DIR_ALMACEN):
+        ruta = os.path.join(DIR_ALMACEN, nombre)
+        try:
+            if os.path.getmtime(ruta) < limite:
+                os.remove(ruta)
+        except OSError:
+            pass    # otro proceso ya lo borró
+
+def ruta_almacen(clave):
+    h = hashlib.sha1(repr((VERSION_ALMACEN,) + tuple(clave)).encode()).hexdigest()
+    return os.path.join(DIR_ALMACEN, h + ".arrow")
+
+def escribir_almacen(tabla, clave):
+    """Escribe la tabla Arrow bajo clave si ningún proceso lo ha hecho ya. Devuelve la ruta."""
+    os.makedirs(DIR_ALMACEN, exist_ok=True)
+    ruta = ruta_almacen(clave)
+    if os.path.exists(ruta):
+        os.utime(ruta)
+    else:
+        tmp = f"{ruta}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with pa.OSFile(tmp, 'wb') as f, pa_ipc.new_file(f, tabla.schema) as w:
+            w.write_table(tabla)
+        os.replace(tmp, ruta)      # atómico: nadie mapea un fichero a medias
+        _purgar_almacen()
+    return ruta
+
+def leer_almacen(clave):
+    """Tabla Arrow guardada bajo clave (en memoria, no mapeada) o None."""
+    try:
+        with pa.OSFile(ruta_almacen(clave)) as f:
+            return pa_ipc.open_file(f).read_all()
+    except FileNotFoundError:
+        return None
+
+def guardar_telemetria(df, clave):
+    """
+    En modo memoria devuelve el propio df. En modo mmap lo escribe (si
+    ningún proceso lo ha hecho ya) y devuelve una VistaTelemetria. clave
+    son los parámetros que determinan la vuelta calculada.
+    """
+    if MODO_ALMACEN != "mmap":
+        return df
+    return VistaTelemetria(escribir_almacen(pa.Table.from_pandas(df), clave), len(df))
+
+def precalcular_vuelta(*args):
+    """Analiza una vuelta terminada y la deja en el almacén sin pasar por la caché del proceso."""
+    if leer_almacen(args) is None:
+        escribir_almacen(pa.Table.from_pandas(_vuelta(*args)), args)
+
+def leer_telemetria(dato):
+    """DataFrame de una vuelta guardada (df, vista o None). None si el fichero ya no existe."""
+    # Duck typing: cada rerun redefine la clase, isinstance fallaría con vistas viejas
+    if not hasattr(dato, 'ruta'):
+        return dato
+    try:
+        return _telemetria_mapeada(dato.ruta)
+    except FileNotFoundError:
+        return None
+
+# ─────────────────────────────────────────────
+#  COMPARACIÓN MULTI-VUELTA / MULTI-PILOTO
+#  Cada vuelta se remuestrea sobre una rejilla
+#  común de distancia; los deltas son arrays 2-D
+#  (K vueltas × N puntos).
+# ─────────────────────────────────────────────
+N_PUNTOS_COMPARACION = 1000
+CANALES_COMPARACION = ['speed', 'throttle', 'brake', 'energia_acum_j', 'tiempo_s']
+
+def vuelta_en_distancia(df, rejilla):
+    """Remuestrea los canales de una vuelta analizada sobre la rejilla de distancia."""
+    d = np.maximum.accumulate(df['dist'].to_numpy())
+    t_ns = fechas_ns(df['date'])
+    canales = {
+        'speed': df['speed'].to_numpy(float),
+        'throttle': df['throttle'].to_numpy(float),
+        'brake': df['brake'].to_numpy(float),
+        'energia_acum_j': np.cumsum(df['energy_j'].to_numpy()),
+        'tiempo_s': (t_ns - t_ns[0]) / 1e9,
+    }
+    return {k: np.interp(rejilla, d, v) for k, v in canales.items()}
+
+def _canales_vuelta(df, pista, n_puntos):
+    # Reproyectada sobre el trazado actual, el mismo que da la longitud de la rejilla
+    df = df.assign(dist=pista.proyectar(df['x'].to_numpy(), df['y'].to_numpy()))
+    rejilla = np.linspace(0.0, pista.longitud, n_puntos)
+    return vuelta_en_distancia(df, rejilla) | {'dist': rejilla}
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _canales_cacheados(session_key, driver_number, meeting_key, t_start, lap_duration,
+                       v_min, muestreo, interpolar, motor, n_puntos, trazado, _df, _pista):
+    return _canales_vuelta(_df, _pista, n_puntos)
+
+def vuelta_comparacion(session_key, driver_number, meeting_key, t_start, lap_duration,
+                       v_min=0, muestreo=1, interpolar=False, motor=MOTOR_KMEANS,
+                       n_puntos=N_PUNTOS_COMPARACION):
+    """
+    Canales de una vuelta sobre la rejilla del circuito (None si no hay datos).
+    Se cachea vuelta a vuelta y por versión del trazado: si una vuelta más
+    rápida lo sustituye, las rejillas se rehacen todas sobre el nuevo.
+    """
+    df = analizar_vuelta(session_key, driver_number, meeting_key, t_start, lap_duration,
+                         v_min, muestreo, interpolar, motor)
+    if df is None or len(df) < 2:
+        return None
+    pista = pista_referencia(meeting_key, df['x'].to_numpy(), df['y'].to_numpy())
+    if pista is None:
+        return None
+    if vuelta_en_vivo(t_start, lap_duration):
+        return _canales_vuelta(df, pista, n_puntos)
+    return _canales_cacheados(session_key, driver_number, meeting_key, t_start, lap_duration,
+                              v_min, muestreo, interpolar, motor, n_puntos, pista.version, df, pista)
+
+def comparar_vueltas(vueltas):
+    """
+    Apila K vueltas remuestreadas en matrices (K, N) por canal y calcula
+    los deltas contra la primera vuelta (referencia).
+    """
+    res = {'dist': vueltas[0]['dist']}
+    for canal in CANALES_COMPARACION:
+        m = np.vstack([v[canal] for v in vueltas])
+        res[canal] = m
+        res['delta_' + canal] = m - m[0]
+    return res
+
+# ─────────────────────────────────────────────
+#  TABLA DE ENERGÍA DE LA SESIÓN (segundo plano)
+#  Una descarga de toda la sesión del piloto y
+#  una tarea por vuelta en un pool de hilos.
+# ─────────────────────────────────────────────
+MAX_TABLAS_ENERGIA = 48   # tablas guardadas; se expulsan las completas menos usadas
+
+@st.cache_resource
+def tablas_energia():
+    """Estado de cada tabla por (sesión, piloto, filtros), compartido entre usuarios (LRU)."""
+    return OrderedDict()
+
+@st.cache_resource
+def _lock_tablas_energia():
+    return threading.Lock()
+
+def tabla_energia(clave):
+    """Estado de una tabla marcándola como usada; None si nunca se lanzó o se expulsó."""
+    tablas = tablas_energia()
+    with _lock_tablas_energia():
+        estado = tablas.get(clave)
+        if estado is not None:
+            tablas.move_to_end(clave)
+        return estado
+
+def resumen_energia_vuelta(df):
+    """Deployment, recuperación, balance neto (MJ) y tiempo de clipping (s) de una vuelta."""
+    key = df['ia_status_key']
+    gasto = df['energy_j'].where(key == IA_DEPLOYMENT, 0).sum() / 1e6
+    carga = -df['energy_j'].where(key == IA_HARVESTING, 0).sum() / 1e6
+    return {
+        'deploy_mj': gasto,
+        'harvest_mj': carga,
+        'net_mj': gasto - carga,
+        'clipping_s': df['dt'].where(key == IA_CLIPPING, 0).sum(),
+    }
+
+def _energia_vuelta(estado, lap_number, df, v_min, muestreo, motor, destino=None):
+    try:
+        if v_min > 0:
+            df = df[df['speed'] >= v_min]
+        if muestreo > 1:
+            df = df.iloc[::muestreo]
+        df = df.dropna(subset=['x', 'y']).reset_index(drop=True)
+        if len(df) < 10:
+            estado['filas'][lap_number] = None
+            return _tabla_terminada(estado)
+        df = calcular_energia_2026(aplicar_ia_f1(df, motor))
+        # Potencia por muestra en float32 para la simulación de carrera (antes que
+        # la fila: una tabla completa implica potencias completas)
+        estado['potencias'][lap_number] = (df['power_w'].to_numpy(np.float32), df['dt'].to_numpy(np.float32))
+        # Antes de la fila: una tabla completa implica vueltas ya materializadas
+        if destino is not None:
+            meeting_key, session_key, driver_number, pista = destino
+            materializar_vuelta(meeting_key, session_key, driver_number, lap_number, motor, df, pista)
+        estado['filas'][lap_number] = resumen_energia_vuelta(df)
+    except Exception as e:
+        # Cuenta como hecha (sin fila): si no, la tabla nunca llegaría a completarse
+        estado['potencias'].pop(lap_number, None)
+        estado['fallos'][lap_number] = str(e)
+        estado['filas'][lap_number] = None
+    _tabla_terminada(estado)
+
+def _tabla_terminada(estado):
+    """
+    La última vuelta en llegar guarda la tabla en el almacén, para que otros
+    procesos la lean en vez de recalcularla. Con fallos o vueltas en vivo no:
+    otro intento o más muestras pueden cambiarla.
+    """
+    if len(estado['filas']) < estado['total'] or estado['fallos'] or not estado['persistir']:
+        return
+    vueltas = sorted(estado['potencias'])
+    trozos = [estado['potencias'][v] for v in vueltas]
+    tabla = pa.table({
+        'lap_number': pa.array(np.repeat(vueltas, [len(p) for p, _ in trozos]), pa.int32()),
+        'power_w': np.concatenate([p for p, _ in trozos] or [np.zeros(0, np.float32)]),
+        'dt': np.concatenate([d for _, d in trozos] or [np.zeros(0, np.float32)]),
+    })
+    filas = {str(v): None if f is None else {k: float(x) for k, x in f.items()} for v, f in estado['filas'].items()}
+    try:
+        escribir_almacen(tabla.replace_schema_metadata({'filas': json.dumps(filas)}), ('energia',) + estado['clave'])
+    except OSError:
+        pass    # sin disco la tabla sigue sirviendo en este proceso
+
+def _cargar_tabla_energia(estado, materializar=False):
+    """
+    Rellena estado con la tabla guardada por otro proceso. False si no hay
+    ninguna o si, debiendo estar materializadas, faltan vueltas en la base de
+    datos (se rehízo o falló al escribir): recalcularla las vuelve a registrar.
+    """
+    tabla = leer_almacen(('energia',) + estado['clave'])
+    if tabla is None:
+        return False
+    filas = {int(v): f for v, f in json.loads(tabla.schema.metadata[b'filas']).items()}
+    if materializar:
+        session_key, driver_number, vueltas, *_, motor = estado['clave']
+        try:
+            guardadas = agregados_temporada().vueltas_guardadas(session_key, driver_number, vueltas, motor)
+        except sqlite3.Error:
+            guardadas = len(vueltas)    # sin base de datos no hay nada que rehacer
+        if guardadas < sum(f is not None for f in filas.values()):
+            return False
+    vuelta = tabla['lap_number'].to_numpy()
+    potencia, dt = tabla['power_w'].to_numpy(), tabla['dt'].to_numpy()
+    cortes = np.r_[0, np.flatnonzero(np.diff(vuelta)) + 1, len(vuelta)]
+    estado['potencias'] = {int(vuelta[a]): (potencia[a:b], dt[a:b]) for a, b in zip(cortes[:-1], cortes[1:]) if b > a}
+    estado['filas'] = filas
+    return True
+
+def _tabla_energia_sesion(estado, session_key, driver_number, laps, v_min, muestreo, interpolar, motor,
+                          meeting_key=None):
+    try:
+        # Mismas ventanas que el análisis de una vuelta: (inicio, inicio + duración + 0.8 s)
+        t0 = fechas_ns(laps['date_start'])
+        t1 = t0 + ((laps['lap_duration'].to_numpy() + 0.8) * 1e9).astype(np.int64)
+        # Solo el rango de las vueltas (location con margen de tolerancia para alinear
+        # los bordes igual que con la sesión entera), en bloques paralelos
+        desde, hasta = pd.Timestamp(t0.min(), tz='UTC'), pd.Timestamp(t1.max(), tz='UTC')
+        margen = pd.Timedelta(TOLERANCIA_POS_NS, unit='ns')
+        params = {"session_key": session_key, "driver_number": driver_number}
+        c_raw = descargar_por_ventanas("car_data", params, desde, hasta)
+        l_raw = descargar_por_ventanas("location", params, desde - margen, hasta + margen)
+        if not (c_raw and l_raw):
+            estado['error'] = "no data"
+            return
+        df = unir_car_location(c_raw, l_raw, interpolar=interpolar)
+        t = fechas_ns(df['date'])
+        i0 = np.searchsorted(t, t0, side='right')
+        i1 = np.searchsorted(t, t1, side='left')
+        destino = None
+        if meeting_key is not None and es_filtro_por_defecto(v_min, muestreo, interpolar):
+            # Misma pista que el análisis: la vuelta más rápida, completa y antes de filtrar
+            r = int(np.argmin(laps['lap_duration'].to_numpy()))
+            df_xy = df.iloc[i0[r]:i1[r]].dropna(subset=['x', 'y'])
+            pista = pista_referencia(meeting_key, df_xy['x'].to_numpy(), df_xy['y'].to_numpy(),
+                                     float(laps['lap_duration'].iloc[r]))
+            if pista is not None:
+                destino = (meeting_key, session_key, driver_number, pista)
+        pool = pool_trabajos()
+        for lap_number, a, b in zip(laps['lap_number'], i0, i1):
+            pool.submit(_energia_vuelta, estado, int(lap_number), df.iloc[a:b], v_min, muestreo, motor, destino)
+    except Exception as e:
+        estado['error'] = str(e)
+
+def lanzar_tabla_energia(session_key, driver_number, laps, v_min=0, muestreo=1, interpolar=False,
+                         motor=MOTOR_KMEANS, meeting_key=None):
+    """
+    Lanza (si no existe ya) el cálculo de energía de todas las vueltas y devuelve
+    su clave. Las filas se van rellenando en tabla_energia(clave)['filas'];
+    las vueltas que fallan quedan en 'fallos' con fila None.
+    Con meeting_key, las vueltas sin filtros se materializan en los agregados.
+    Las vueltas forman parte de la clave: si se publican más (sesión en vivo)
+    se lanza una tabla nueva en vez de devolver la que ya estaba completa.
+    """
+    vueltas = tuple(int(n) for n in laps['lap_number'])
+    clave = (session_key, driver_number, vueltas, v_min, muestreo, interpolar, motor)
+    persistir = not laps.empty and not vuelta_en_vivo(laps['date_start'].max(), float(laps['lap_duration'].max()))
+    nuevo = {'filas': {}, 'potencias': {}, 'fallos': {}, 'total': len(laps), 'error': None,
+             'clave': clave, 'persistir': persistir}
+    tablas = tablas_energia()
+    with _lock_tablas_energia():
+        if tablas.get(clave, {}).get('error'):
+            tablas.pop(clave, None)
+        lanzada = tablas.setdefault(clave, nuevo) is nuevo
+        tablas.move_to_end(clave)
+        # Solo se expulsan tablas completas: las que están en curso siguen rellenándose
+        completas = [c for c, e in tablas.items() if tabla_completa(e)]
+        for c in completas[:max(len(tablas) - MAX_TABLAS_ENERGIA, 0)]:
+            del tablas[c]
+    materializar = meeting_key is not None and es_filtro_por_defecto(v_min, muestreo, interpolar)
+    if lanzada and not (persistir and _cargar_tabla_energia(nuevo, materializar)):
+        laps = laps[['lap_number', 'date_start', 'lap_duration']].copy()
+        pool_trabajos().submit(_tabla_energia_sesion, nuevo, session_key, driver_number,
+                               laps, v_min, muestreo, interpolar, motor, meeting_key)
+    return clave
+
+def tabla_completa(estado):
+    return estado is not None and (len(estado['filas']) >= estado['total'] or estado['error'] is not None)
+
+# ─────────────────────────────────────────────
+#  AGREGADOS DE TEMPORADA (SQLite)
+#  Cada vuelta calculada con los filtros por
+#  defecto se materializa una vez por segmento
+#  de circuito; los acumulados por circuito y
+#  piloto se actualizan en la misma transacción.
+# ─────────────────────────────────────────────
+RUTA_AGREGADOS = os.environ.get("F1_AGGREGATES_DB",
+                                os.path.join(tempfile.gettempdir(), "f1-explained-temporada.sqlite"))
+VERSION_AGREGADOS = 2   # subirla si cambia el modelo de energía o de fases (se reconstruye)
+TABLAS_AGREGADOS = ["pistas_circuito", "segmentos_circuito", "vueltas", "vueltas_segmento", "agg_segmento", "agg_piloto"]
+COLUMNAS_AGREGADO = ['clipping_s', 'deploy_mj', 'harvest_mj', 'n_clipping', 'v_clipping_max']
+
+ESQUEMA_AGREGADOS = """
+CREATE TABLE IF NOT EXISTS pistas_circuito (
+    meeting_key INTEGER PRIMARY KEY, x BLOB NOT NULL, y BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS segmentos_circuito (
+    meeting_key INTEGER NOT NULL, segmento_id INTEGER NOT NULL, tipo TEXT NOT NULL,
+    numero INTEGER NOT NULL, dist_inicio REAL NOT NULL, dist_fin REAL NOT NULL,
+    PRIMARY KEY (meeting_key, segmento_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS vueltas (
+    session_key INTEGER NOT NULL, driver_number INTEGER NOT NULL, lap_number INTEGER NOT NULL,
+    motor TEXT NOT NULL, meeting_key INTEGER NOT NULL,
+    clipping_s REAL, deploy_mj REAL, harvest_mj REAL, n_clipping INTEGER, v_clipping_max REAL,
+    PRIMARY KEY (session_key, driver_number, lap_number, motor)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS vueltas_por_meeting ON vueltas (meeting_key, motor, driver_number);
+CREATE TABLE IF NOT EXISTS vueltas_segmento (
+    session_key INTEGER NOT NULL, driver_number INTEGER NOT NULL, lap_number INTEGER NOT NULL,
+    motor TEXT NOT NULL, segmento_id INTEGER NOT NULL, meeting_key INTEGER NOT NULL,
+    clipping_s REAL, deploy_mj REAL, harvest_mj REAL, n_clipping INTEGER, v_clipping_max REAL,
+    PRIMARY KEY (session_key, driver_number, lap_number, motor, segmento_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS vueltas_segmento_por_meeting ON vueltas_segmento (meeting_key, motor, segmento_id);
+CREATE TABLE IF NOT EXISTS agg_segmento (
+    meeting_key INTEGER NOT NULL, motor TEXT NOT NULL, segmento_id INTEGER NOT NULL, vueltas INTEGER,
+    clipping_s REAL, deploy_mj REAL, harvest_mj REAL, n_clipping INTEGER, v_clipping_max REAL,
+    PRIMARY KEY (meeting_key, motor, segmento_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS agg_piloto (
+    motor TEXT NOT NULL, meeting_key INTEGER NOT NULL, driver_number INTEGER NOT NULL, vueltas INTEGER,
+    clipping_s REAL, deploy_mj REAL, harvest_mj REAL, n_clipping INTEGER, v_clipping_max REAL,
+    PRIMARY KEY (motor, meeting_key, driver_number)
+) WITHOUT ROWID;
+"""
+
+# Suma incremental de una vuelta sobre un acumulado (MAX ignora los NULL de vueltas sin clipping)
+_SUMAR_VUELTA = """
+    vueltas = vueltas + 1,
+    clipping_s = clipping_s + excluded.clipping_s,
+    deploy_mj = deploy_mj + excluded.deploy_mj,
+    harvest_mj = harvest_mj + excluded.harvest_mj,
+    n_clipping = n_clipping + excluded.n_clipping,
+    v_clipping_max = MAX(COALESCE(v_clipping_max, excluded.v_clipping_max),
+                         COALESCE(excluded.v_clipping_max, v_clipping_max))
+"""
+
+def es_filtro_por_defecto(v_min, muestreo, interpolar):
+    """Solo las vueltas sin filtros son comparables entre sí: las demás no se materializan."""
+    return v_min == 0 and muestreo == 1 and not interpolar
+
+def agregar_por_segmento(df, limites):
+    """
+    Clipping (s), deployment/recuperación (MJ), número de inicios de clipping
+    y velocidad máxima al iniciar clipping por segmento. limites son los
+    dist_inicio de los segmentos del circuito; df necesita 'dist'.
+    """
+    n = len(limites)
+    seg = np.clip(np.searchsorted(limites, df['dist'].to_numpy(), side='right') - 1, 0, n - 1)
+    key = df['ia_status_key'].to_numpy()
+    dt = df['dt'].to_numpy()
+    energia = df['energy_j'].to_numpy()
+    clip = key == IA_CLIPPING
+    inicio = clip & ~np.r_[False, clip[:-1]]
+    v_inicio = np.full(n, np.nan)
+    np.fmax.at(v_inicio, seg[inicio], df['speed'].to_numpy(np.float64)[inicio])
+    return pd.DataFrame({
+        'segmento_id': np.arange(n),
+        'clipping_s': np.bincount(seg, np.where(clip, dt, 0.0), n),
+        'deploy_mj': np.bincount(seg, np.where(key == IA_DEPLOYMENT, energia, 0.0), n) / 1e6,
+        'harvest_mj': -np.bincount(seg, np.where(key == IA_HARVESTING, energia, 0.0), n) / 1e6,
+        'n_clipping': np.bincount(seg[inicio], minlength=n),
+        'v_clipping_max': v_inicio,
+    })
+
+class AgregadosTemporada:
+    """Tablas materializadas de la temporada; una conexión por proceso protegida con un lock."""
+
+    def __init__(self, ruta):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self._con = sqlite3.connect(ruta, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._referencias = {}   # meeting_key -> (PistaReferencia, límites) leídos de la base de datos
+        self.ultimo_error = None
+        self._con.execute("PRAGMA journal_mode = WAL")      # lecturas sin bloquear a otros procesos
+        self._con.execute("PRAGMA synchronous = NORMAL")
+        if self._con.execute("PRAGMA user_version").fetchone()[0] != VERSION_AGREGADOS:
+            for tabla in TABLAS_AGREGADOS:
+                self._con.execute(f"DROP TABLE IF EXISTS {tabla}")
+            self._con.execute(f"PRAGMA user_version = {VERSION_AGREGADOS}")
+        self._con.executescript(ESQUEMA_AGREGADOS)
+
+    # ── Escritura incremental ────────────────────────────
+    def _referencia(self, meeting_key, pista):
+        """
+        Trazado y segmentos del circuito fijados por la primera pista que llega
+        a la base de datos desde cualquier proceso. Las distancias de todas las
+        vueltas se miden sobre ese mismo trazado, no sobre la pista del proceso.
+        A diferencia de pista_referencia, una vuelta más rápida no lo sustituye:
+        cambiarían los límites y habría que rehacer todas las vueltas guardadas
+        del circuito. Un trazado algo peor solo desplaza un poco las fronteras.
+        """
+        ref = self._referencias.get(meeting_key)
+        if ref is not None:
+            return ref
+        seg = pista.segmentos
+        # Transacción propia y OR IGNORE: si otro proceso se adelantó, se queda su trazado
+        with self._con:
+            self._con.execute("INSERT OR IGNORE INTO pistas_circuito VALUES (?, ?, ?)",
+                              (meeting_key, pista.x.astype(np.float64).tobytes(),
+                               pista.y.astype(np.float64).tobytes()))
+            self._con.executemany(
+                "INSERT OR IGNORE INTO segmentos_circuito VALUES (?, ?, ?, ?, ?, ?)",
+                [(meeting_key, int(i), str(t), int(n), float(a), float(b)) for i, t, n, a, b in zip(
+                    seg['segmento_id'], seg['tipo'], seg['numero'], seg['dist_inicio'], seg['dist_fin'])])
+        x, y = self._con.execute("SELECT x, y FROM pistas_circuito WHERE meeting_key = ?", (meeting_key,)).fetchone()
+        limites = np.array([f[0] for f in self._con.execute(
+            "SELECT dist_inicio FROM segmentos_circuito WHERE meeting_key = ? ORDER BY segmento_id",
+            (meeting_key,))])
+        ref = (PistaReferencia(np.frombuffer(x), np.frombuffer(y)), limites)
+        self._referencias[meeting_key] = ref
+        return ref
+
+    def registrar_vuelta(self, meeting_key, session_key, driver_number, lap_number, motor, df, pista):
+        """
+        Materializa una vuelta calculada (df con x, y, dt, energy_j, speed e
+        ia_status_key) y suma su aporte a los acumulados. pista solo se usa si
+        el circuito aún no tiene trazado guardado. Devuelve False si ya estaba:
+        el cálculo es determinista, así que la primera escritura vale.
+        """
+        ids = (int(session_key), int(driver_number), int(lap_number), motor)
+        meeting_key = int(meeting_key)
+        with self._lock:
+            ref, limites = self._referencia(meeting_key, pista)
+        df = df.assign(dist=ref.proyectar(df['x'].to_numpy(), df['y'].to_numpy()))
+        seg = agregar_por_segmento(df, limites)
+        total = [float(seg[c].sum()) for c in COLUMNAS_AGREGADO[:3]] + \
+                [int(seg['n_clipping'].sum()), float(seg['v_clipping_max'].max())]
+        filas = seg[['segmento_id'] + COLUMNAS_AGREGADO].to_numpy().tolist()
+        with self._lock, self._con:
+            # OR IGNORE en vez de comprobar antes: otro proceso puede escribir la misma vuelta a la vez
+            if self._con.execute("INSERT OR IGNORE INTO vueltas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 ids + (meeting_key, *total)).rowcount == 0:
+                return False
+            self._con.executemany("INSERT INTO vueltas_segmento VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                  [ids + (int(f[0]), meeting_key, *f[1:]) for f in filas])
+            self._con.executemany(
+                "INSERT INTO agg_segmento VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (meeting_key, motor, segmento_id) DO UPDATE SET" + _SUMAR_VUELTA,
+                [(meeting_key, motor, int(f[0]), *f[1:]) for f in filas])
+            self._con.execute(
+                "INSERT INTO agg_piloto VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (motor, meeting_key, driver_number) DO UPDATE SET" + _SUMAR_VUELTA,
+                (motor, meeting_key, ids[1], *total))
+        return True
+
+    # ── Consultas (todas por clave primaria o índice) ────
+    def vueltas_guardadas(self, session_key, driver_number, lap_numbers, motor):
+        marcas = ", ".join("?" * len(lap_numbers))
+        with self._lock:
+            return self._con.execute(
+                f"SELECT COUNT(*) FROM vueltas WHERE session_key = ? AND driver_number = ? AND motor = ? "
+                f"AND lap_number IN ({marcas})",
+                (int(session_key), int(driver_number), motor, *map(int, lap_numbers))).fetchone()[0]
+
+    def _consulta(self, sql, params=()):
+        with self._lock:
+            df = pd.read_sql_query(sql, self._con, params=params)
+        # Sin ningún clipping la columna llega como None (object): forzar NaN
+        return df.astype({'v_clipping_max': np.float64}) if 'v_clipping_max' in df else df
+
+    def resumen(self, motor):
+        return self._consulta(
+            "SELECT meeting_key, SUM(vueltas) AS vueltas FROM agg_piloto WHERE motor = ? GROUP BY meeting_key",
+            (motor,))
+
+    def por_piloto(self, meeting_keys, motor):
+        """Media por vuelta de cada piloto sobre los circuitos dados (v_clipping_max es el máximo)."""
+        marcas = ", ".join("?" * len(meeting_keys))
+        return self._consulta(f"""
+            SELECT driver_number, SUM(vueltas) AS vueltas,
+                   SUM(clipping_s) / SUM(vueltas) AS clipping_s,
+                   SUM(deploy_mj) / SUM(vueltas) AS deploy_mj,
+                   SUM(harvest_mj) / SUM(vueltas) AS harvest_mj,
+                   CAST(SUM(n_clipping) AS REAL) / SUM(vueltas) AS n_clipping,
+                   MAX(v_clipping_max) AS v_clipping_max
+            FROM agg_piloto WHERE motor = ? AND meeting_key IN ({marcas})
+            GROUP BY driver_number ORDER BY harvest_mj DESC""", (motor, *map(int, meeting_keys)))
+
+    def por_segmento(self, meeting_key, motor):
+        """Media por vuelta de cada segmento del circuito, con su tipo y distancias (v_clipping_max es el máximo)."""
+        return self._consulta("""
+            SELECT s.segmento_id, s.tipo, s.numero, s.dist_inicio, s.dist_fin, a.vueltas,
+                   a.clipping_s / a.vueltas AS clipping_s, a.deploy_mj / a.vueltas AS deploy_mj,
+                   a.harvest_mj / a.vueltas AS harvest_mj,
+                   CAST(a.n_clipping AS REAL) / a.vueltas AS n_clipping, a.v_clipping_max
+            FROM agg_segmento a JOIN segmentos_circuito s USING (meeting_key, segmento_id)
+            WHERE a.meeting_key = ? AND a.motor = ? ORDER BY a.segmento_id""", (int(meeting_key), motor))
+
+    def vueltas_de(self, meeting_key, motor):
+        return self._consulta("""
+            SELECT session_key, driver_number, lap_number, clipping_s, deploy_mj, harvest_mj,
+                   n_clipping, v_clipping_max
+            FROM vueltas WHERE meeting_key = ? AND motor = ?
+            ORDER BY driver_number, session_key, lap_number""", (int(meeting_key), motor))
+
+@st.cache_resource(show_spinner=False)
+def agregados_temporada():
+    return AgregadosTemporada(RUTA_AGREGADOS)
+
+def materializar_vuelta(meeting_key, session_key, driver_number, lap_number, motor, df, pista):
+    """Registra la vuelta sin interrumpir a quien la calculó si la base de datos falla."""
+    agregados = agregados_temporada()
+    try:
+        return agregados.registrar_vuelta(meeting_key, session_key, driver_number, lap_number, motor, df, pista)
+    except Exception as e:
+        agregados.ultimo_error = str(e)
+        return False
+
+# ─────────────────────────────────────────────
+#  SIMULACIÓN DE BATERÍA (SoC) EN CARRERA
+#  Límite de recuperación por vuelta con cumsum +
+#  máscaras de recorte sobre toda la carrera; el
+#  SoC se integra paso a paso vectorizado por piloto.
+# ─────────────────────────────────────────────
+CAPACIDAD_BATERIA_MJ = 4.0  # ventana útil de SoC del ES 2026
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def simulacion_carrera_cacheada(claves, energy_limit_mj, _potencias):
+    """
+    simular_soc_carrera con tablas ya completas. Las claves de las tablas
+    (pilotos, vueltas y filtros) identifican las potencias, así que no se
+    hashean los arrays en cada rerun.
+    """
+    return simular_soc_carrera(_potencias, energy_limit_mj)
+
+def simular_soc_carrera(potencias, energy_limit_mj, capacidad_mj=CAPACIDAD_BATERIA_MJ, soc_inicial=1.0):
+    """
+    potencias: {piloto: {vuelta: (power_w, dt)}}. Devuelve un DataFrame por
+    piloto y vuelta con SoC al final/mínimo, energía entregada, deployment
+    no servido por falta de batería (y su tiempo) y harvest desperdiciado
+    por el límite de la vuelta o por batería llena.
+    """
+    pilotos = list(potencias)
+    series = []
+    for d in pilotos:
+        vueltas = sorted(potencias[d])
+        e = [potencias[d][v][0].astype(np.float64) * potencias[d][v][1] for v in vueltas]
+        series.append((
+            np.concatenate(e) if e else np.zeros(0),
+            np.concatenate([potencias[d][v][1] for v in vueltas]) if e else np.zeros(0),
+            np.repeat(vueltas, [len(x) for x in e]).astype(np.int64),
+        ))
+    D, S = len(pilotos), max((len(s[0]) for s in series), default=0)
+    energia = np.zeros((D, S))
+    dt = np.zeros((D, S))
+    vuelta = np.full((D, S), -1, dtype=np.int64)
+    for i, (e, t, v) in enumerate(series):
+        energia[i, :len(e)], dt[i, :len(e)], vuelta[i, :len(e)] = e, t, v
+
+    cap = capacidad_mj * 1e6
+    limite = energy_limit_mj * 1e6
+    demanda = np.maximum(energia, 0)
+    harvest = np.maximum(-energia, 0)
+
+    # Harvest acumulado dentro de cada vuelta → recorte por el límite de la vuelta
+    acum = np.cumsum(harvest, axis=1)
+    nueva_vuelta = np.ones((D, S), dtype=bool)
+    nueva_vuelta[:, 1:] = vuelta[:, 1:] != vuelta[:, :-1]
+    base = np.maximum.accumulate(np.where(nueva_vuelta, acum - harvest, -np.inf), axis=1)
+    previo = acum - harvest - base
+    harvest_ok = np.clip(limite - previo, 0, harvest)
+
+    # Integración del SoC: un paso por muestra, vectorizado sobre pilotos
+    soc = np.empty((D, S))
+    entregado = np.empty((D, S))
+    desbordado = np.empty((D, S))
+    s = np.full(D, soc_inicial * cap)
+    for t in range(S):
+        s = s + harvest_ok[:, t]
+        desbordado[:, t] = np.maximum(s - cap, 0)
+        s = np.minimum(s, cap)
+        entregado[:, t] = np.minimum(demanda[:, t], s)
+        s = s - entregado[:, t]
+        soc[:, t] = s
+
+    sin_bateria = demanda - entregado > 1.0  # J
+    valido = vuelta >= 0
+    tabla = pd.DataFrame({
+        'driver_number': np.repeat(pilotos, S)[valido.ravel()],
+        'lap_number': vuelta[valido],
+        'soc_mj': soc[valido] / 1e6,
+        'deploy_mj': entregado[valido] / 1e6,
+        'starved_mj': (demanda - entregado)[valido] / 1e6,
+        'starved_s': np.where(sin_bateria, dt, 0)[valido],
+        'harvest_mj': (harvest_ok - desbordado)[valido] / 1e6,
+        'wasted_mj': (harvest - harvest_ok + desbordado)[valido] / 1e6,
+    })
+    return tabla.groupby(['driver_number', 'lap_number'], sort=True).agg(
+        soc_fin_mj=('soc_mj', 'last'),
+        soc_min_mj=('soc_mj', 'min'),
+        deploy_mj=('deploy_mj', 'sum'),
+        starved_mj=('starved_mj', 'sum'),
+        starved_s=('starved_s', 'sum'),
+        harvest_mj=('harvest_mj', 'sum'),
+        wasted_mj=('wasted_mj', 'sum'),
+    ).reset_index()
+
+# ─────────────────────────────────────────────
+#  ÍNDICE DE METADATOS DE TEMPORADA
+#  meetings → sessions → drivers → laps en memoria.
+#  Se construye una vez por año y se refresca en
+#  segundo plano; los selectores no tocan la red.
+# ─────────────────────────────────────────────
+TEMPORADAS = [2026]            # años seleccionables; el último es la temporada en curso
+INTERVALO_REFRESCO_S = 300     # cada cuánto buscar sesiones nuevas
+INTERVALO_VUELTAS_VIVO_S = 60  # vueltas de una sesión en curso
+MARGEN_VUELTAS_FINALES = pd.Timedelta(minutes=10)  # OpenF1 publica las últimas vueltas tras date_end
+MAX_ESPERA_PILOTOS_S = 3600    # tope del backoff entre peticiones de pilotos sin resultado
+
+def _fecha_utc(valor):
+    return pd.to_datetime(valor, utc=True) if valor else None
+
+class IndiceTemporada:
+    """Metadatos de un año. Las lecturas no bloquean; las escrituras reemplazan dicts completos."""
+
+    def __init__(self, year):
+        self.year = year
+        self.meetings = {}   # meeting_key -> meeting
+        self.sesiones = {}   # meeting_key -> [session] ordenadas por fecha
+        self.sesiones_por_key = {}
+        self.pilotos = {}    # session_key -> [driver]
+        self.pedidos_pilotos = {}   # ('meeting'|'session', key) -> (intentos sin resultado, instante)
+        self.vueltas = {}    # session_key -> (DataFrame de vueltas, instante de descarga, definitivas)
+        self.actualizado = 0.0
+        self.listo = threading.Event()   # primera carga terminada (con o sin respuesta)
+        self._lock = threading.Lock()
+        self._refrescando = False
+
+    # ── Construcción / refresco incremental ──────────────
+    def refrescar(self):
+        """Trae meetings y sessions del año (2 llamadas) y pilotos de las sesiones nuevas."""
+        try:
+            meetings = get_data_api("meetings", {"year": self.year})
+            sessions = get_data_api("sessions", {"year": self.year})
+            if meetings:
+                self.meetings = {m['meeting_key']: m for m in meetings}
+            if sessions:
+                por_meeting = {}
+                for ses in sorted(sessions, key=lambda x: x.get('date_start') or ''):
+                    por_meeting.setdefault(ses['meeting_key'], []).append(ses)
+                self.sesiones = por_meeting
+                self.sesiones_por_key = {ses['session_key']: ses for ses in sessions}
+                # Solo sesiones ya empezadas: antes OpenF1 no tiene sus pilotos
+                ahora = pd.Timestamp.now(tz='UTC')
+                sin_pilotos = []
+                for ses in sessions:
+                    inicio = _fecha_utc(ses.get('date_start'))
+                    if ses['session_key'] not in self.pilotos and inicio is not None and inicio <= ahora:
+                        sin_pilotos.append(ses)
+                for meeting_key in {ses['meeting_key'] for ses in sin_pilotos}:
+                    if self._toca_pedir_pilotos(('meeting', meeting_key)):
+                        self._cargar_pilotos_meeting(meeting_key)
+                        self._anotar_pedido_pilotos(('meeting', meeting_key), all(
+                            ses['session_key'] in self.pilotos
+                            for ses in sin_pilotos if ses['meeting_key'] == meeting_key))
+            # Sin respuesta no cuenta como refresco: se reintenta en el siguiente rerun
+            if meetings and sessions:
+                self.actualizado = time.time()
+        finally:
+            self.listo.set()
+
+    def _toca_pedir_pilotos(self, clave):
+        """Backoff exponencial desde INTERVALO_REFRESCO_S mientras la API no devuelva los pilotos."""
+        intentos, instante = self.pedidos_pilotos.get(clave, (0, 0.0))
+        if not intentos:
+            return True
+        return time.time() - instante >= min(INTERVALO_REFRESCO_S * 2 ** (intentos - 1), MAX_ESPERA_PILOTOS_S)
+
+    def _anotar_pedido_pilotos(self, clave, completo):
+        intentos = 0 if completo else self.pedidos_pilotos.get(clave, (0, 0.0))[0] + 1
+        self.pedidos_pilotos = self.pedidos_pilotos | {clave: (intentos, time.time())}
+
+    def _cargar_pilotos_meeting(self, meeting_key):
+        d_raw = get_data_api("drivers", {"meeting_key": meeting_key})
+        por_sesion = {}
+        for d in d_raw:
+            por_sesion.setdefault(d['session_key'], []).append(d)
+        self.pilotos = self.pilotos | por_sesion
+
+    def refrescar_en_segundo_plano(self):
+        """Lanza un refresco en el pool si ha pasado el intervalo y no hay otro en curso."""
+        with self._lock:
+            if self._refrescando or time.time() - self.actualizado < INTERVALO_REFRESCO_S:
+                return
+            self._refrescando = True
+
+        def _tarea():
+            try:
+                self.refrescar()
+            finally:
+                self._refrescando = False
+
+        pool_trabajos().submit(_tarea)
+
+    def esperar_carga(self, timeout=None):
+        """Para hilos que pueden bloquear (API): lanza la primera carga si hace falta y la espera."""
+        self.refrescar_en_segundo_plano()
+        return self.listo.wait(timeout)
+
+    # ── Lecturas ─────────────────────────────────────────
+    def lista_meetings(self):
+        return list(self.meetings.values())
+
+    def sesiones_de(self, meeting_key):
+        return self.sesiones.get(meeting_key, [])
+
+    def pilotos_de(self, session_key):
+        if session_key not in self.pilotos:
+            # Sesión aún no indexada: una descarga; una lista vacía (pilotos aún no
+            # publicados o API caída) no se guarda para volver a pedirla, con backoff
+            if not self._toca_pedir_pilotos(('session', session_key)):
+                return []
+            pilotos = get_data_api("drivers", {"session_key": session_key})
+            self._anotar_pedido_pilotos(('session', session_key), bool(pilotos))
+            if not pilotos:
+                return []
+            self.pilotos = self.pilotos | {session_key: pilotos}
+        return self.pilotos[session_key]
+
+    def sesion_terminada(self, session_key, margen=pd.Timedelta(0)):
+        fin = _fecha_utc(self.sesiones_por_key.get(session_key, {}).get('date_end'))
+        return fin is not None and fin + margen < pd.Timestamp.now(tz='UTC')
+
+    def vueltas_de(self, session_key):
+        """
+        Vueltas de todos los pilotos. Las bajadas con la sesión ya terminada (y
+        el margen de publicación pasado) son definitivas; las bajadas en vivo
+        caducan cada INTERVALO_VUELTAS_VIVO_S, también cuando la sesión acaba,
+        así que la lista incompleta se sustituye por la final.
+        """
+        cacheadas = self.vueltas.get(session_key)
+        if cacheadas is not None:
+            df_l, instante, definitivas = cacheadas
+            if definitivas or time.time() - instante < INTERVALO_VUELTAS_VIVO_S:
+                return df_l
+        definitivas = self.sesion_terminada(session_key, MARGEN_VUELTAS_FINALES)
+        laps_raw = get_data_api("laps", {"session_key": session_key})
+        if not laps_raw:
+            return pd.DataFrame(columns=['driver_number', 'lap_number', 'date_start', 'lap_duration'])
+        df_l = pd.DataFrame(laps_raw).dropna(subset=['date_start', 'lap_duration'])
+        df_l['date_start'] = pd.to_datetime(df_l['date_start'], format='mixed')
+        df_l = df_l.sort_values(['driver_number', 'lap_number'])
+        self.vueltas = self.vueltas | {session_key: (df_l, time.time(), definitivas)}
+        return df_l
+
+@st.cache_resource(show_spinner=False)
+def indice_temporada(year):
+    """Se construye vacío: la primera carga va al pool (refrescar_en_segundo_plano)."""
+    return IndiceTemporada(year)
+
+def esperar_indice(indice):
+    """
+    False mientras dura la primera carga del índice: un fragmento la sondea
+    y relanza el script al terminar, sin bloquear el rerun.
+    """
+    indice.refrescar_en_segundo_plano()
+    if indice.listo.is_set():
+        return True
+
+    def _cargando(en_linea):
+        st.info(T["index_loading"])
+        if indice.listo.is_set() and not en_linea:
+            st.rerun()
+
+    sondear(_cargando, "_index_inline", 0.5)
+    return False
+
+# ─────────────────────────────────────────────
+#  VIGILANTE DE SESIONES TERMINADAS
+#  Hilo del servidor que detecta sesiones recién
+#  acabadas y precalcula la tabla de energía de
+#  todos los pilotos antes de que llegue nadie.
+# ─────────────────────────────────────────────
+INTERVALO_VIGILANTE_S = 120
+VENTANA_SESION_RECIENTE = pd.Timedelta(hours=24)
+MAX_PILOTOS_EN_PARALELO = 2
+MAX_VUELTAS_EN_PARALELO = 2      # deja hueco en pool_trabajos a los análisis de los usuarios
+TIEMPO_MAX_TABLA_S = 15 * 60     # una tabla que no termina en este tiempo se da por fallida
+MAX_INTENTOS_SESION = 3          # ciclos con fallos antes de dar la sesión por procesada
+RUTA_BLOQUEO_VIGILANTE = os.path.join(tempfile.gettempdir(), "f1-explained-vigilante-{year}.lock")
+
+class VigilanteSesiones:
+    """Sondea las sesiones del año y encola el pipeline completo de cada sesión terminada."""
+
+    def __init__(self, year):
+        self.year = year
+        self.procesadas = set()
+        self.intentos = {}
+        self.en_curso = None
+        self.ultimo_error = None
+        self._bloqueo = None
+        self._hilo = threading.Thread(target=self._bucle, name="f1-vigilante", daemon=True)
+        self._hilo.start()
+
+    def _bucle(self):
+        while True:
+            try:
+                if self._tomar_bloqueo():
+                    self.ciclo()
+            except Exception as e:
+                self.ultimo_error = str(e)
+            time.sleep(INTERVALO_VIGILANTE_S)
+
+    def _tomar_bloqueo(self):
+        """
+        Con varios procesos de servidor solo vigila el que tiene el flock del
+        año. El resto lo reintenta cada ciclo: si ese proceso muere, el sistema
+        libera el bloqueo y otro toma el relevo.
+        """
+        if self._bloqueo is not None or fcntl is None:
+            return True
+        f = open(RUTA_BLOQUEO_VIGILANTE.format(year=self.year), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._bloqueo = f
+        return True
+
+    def sesiones_recien_terminadas(self, indice):
+        # Tras el margen de publicación: antes, la lista de vueltas puede estar incompleta
+        ahora = pd.Timestamp.now(tz='UTC') - MARGEN_VUELTAS_FINALES
+        for session_key, ses in indice.sesiones_por_key.items():
+            fin = _fecha_utc(ses.get('date_end'))
+            if fin is not None and ahora - VENTANA_SESION_RECIENTE < fin < ahora \
+                    and session_key not in self.procesadas:
+                yield session_key
+
+    def ciclo(self):
+        indice = indice_temporada(self.year)
+        indice.refrescar()
+        for session_key in list(self.sesiones_recien_terminadas(indice)):
+            laps = indice.vueltas_de(session_key)
+            if laps.empty:
+                continue  # OpenF1 aún no publicó las vueltas: reintentar en el próximo ciclo
+            self.en_curso = session_key
+            ok = self.precalcular_sesion(session_key, laps)
+            self.en_curso = None
+            if len(indice.vueltas_de(session_key)) != len(laps):
+                continue  # se publicaron más vueltas mientras tanto: el próximo ciclo las cubre
+            self.intentos[session_key] = self.intentos.get(session_key, 0) + 1
+            if ok or self.intentos[session_key] >= MAX_INTENTOS_SESION:
+                self.procesadas.add(session_key)
+
+    def precalcular_sesion(self, session_key, laps):
+        """
+        Tabla de energía de cada piloto con los filtros por defecto, pocos pilotos
+        a la vez, y después el análisis de cada vuelta. Todo queda en el almacén,
+        que leen todos los procesos. Una tabla solo cuenta como hecha si llegó al
+        almacén (todas sus vueltas, sin fallos); una que supera TIEMPO_MAX_TABLA_S
+        o una vuelta que falla, como fallidas. Devuelve True si no hubo fallos.
+        """
+        meeting_key = indice_temporada(self.year).sesiones_por_key.get(session_key, {}).get('meeting_key')
+        pendientes = list(laps.groupby('driver_number'))
+        activos = {}    # clave -> instante de lanzamiento
+        fallos = []
+        while pendientes or activos:
+            for clave, inicio in list(activos.items()):
+                estado = tabla_energia(clave)
+                if estado is None or tabla_completa(estado):
+                    if not os.path.exists(ruta_almacen(('energia',) + clave)):
+                        motivo = "evicted" if estado is None else estado['error'] or f"laps failed {sorted(estado['fallos'])}"
+                        fallos.append(f"driver {clave[1]}: {motivo}")
+                    del activos[clave]
+                elif time.time() - inicio > TIEMPO_MAX_TABLA_S:
+                    fallos.append(f"driver {clave[1]}: timeout")
+                    del activos[clave]
+            while pendientes and len(activos) < MAX_PILOTOS_EN_PARALELO:
+                driver_number, laps_d = pendientes.pop(0)
+                clave = lanzar_tabla_energia(session_key, int(driver_number), laps_d, meeting_key=meeting_key)
+                activos[clave] = time.time()
+            time.sleep(1)
+        if meeting_key is not None:
+            fallos += self.precalcular_vueltas(session_key, meeting_key, laps)
+        if fallos:
+            self.ultimo_error = f"session {session_key}: " + "; ".join(fallos)
+        return not fallos
+
+    def precalcular_vueltas(self, session_key, meeting_key, laps):
+        """analizar_vuelta de cada vuelta con los filtros por defecto (la ruta de «Analizar»)."""
+        pool = pool_trabajos()
+        activos, fallos = {}, []
+        filas = list(laps[['driver_number', 'lap_number', 'date_start', 'lap_duration']].itertuples(index=False))
+        while filas or activos:
+            while filas and len(activos) < MAX_VUELTAS_EN_PARALELO:
+                v = filas.pop(0)
+                args = (session_key, int(v.driver_number), meeting_key, v.date_start, float(v.lap_duration),
+                        0, 1, False, MOTOR_KMEANS)
+                activos[pool.submit(precalcular_vuelta, *args)] = (int(v.driver_number), int(v.lap_number))
+            hechos, _ = wait(activos, return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                driver_number, lap_number = activos.pop(futuro)
+                if futuro.exception() is not None and not isinstance(futuro.exception(), SinTelemetria):
+                    fallos.append(f"driver {driver_number} lap {lap_number}: {futuro.exception()}")
+        return fallos
+
+@st.cache_resource(show_spinner=False)
+def vigilante_sesiones(year):
+    return VigilanteSesiones(year)
+
+if os.environ.get("F1_WATCHER", "1") != "0":
+    vigilante_sesiones(TEMPORADAS[-1])
+
+# ─────────────────────────────────────────────
+#  MEMORIA DE SESIÓN (presupuesto global)
+#  Los datos pesados de cada usuario viven en un
+#  registro compartido con límite de bytes y
+#  expulsión LRU / por inactividad. session_state
+#  solo guarda la receta (fn, args) para rehacerlos
+#  desde las cachés compartidas si se expulsan.
+# ─────────────────────────────────────────────
+PRESUPUESTO_MEMORIA_MB = float(os.environ.get("F1_MEMORY_BUDGET_MB", 512))
+INACTIVIDAD_MAX_S      = float(os.environ.get("F1_IDLE_EVICT_S", 1800))
+
+def tamano_bytes(valor):
+    """Estimación de la memoria de un dato de sesión (DataFrames, arrays y contenedores)."""
+    if isinstance(valor, pd.DataFrame):
+        return int(valor.memory_usage(deep=True).sum())
+    if isinstance(valor, np.ndarray):
+        return valor.nbytes
+    if isinstance(valor, dict):
+        return sum(tamano_bytes(v) for v in valor.values())
+    if isinstance(valor, (list, tuple)):
+        return sum(tamano_bytes(v) for v in valor)
+    return 0
+
+class RegistroMemoria:
+    """
+    Datos de análisis de todas las sesiones del servidor, en orden LRU.
+    Cada entrada es (sesión, nombre) -> [valor, bytes, último acceso].
+    """
+
+    def __init__(self, presupuesto_bytes, inactividad_s):
+        self.presupuesto = presupuesto_bytes
+        self.inactividad_s = inactividad_s
+        self.expulsiones = 0
+        self.recalculos = 0
+        self._datos = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def guardar(self, sesion, nombre, valor):
+        with self._lock:
+            self._quitar((sesion, nombre))
+            n = tamano_bytes(valor)
+            self._datos[(sesion, nombre)] = [valor, n, time.monotonic()]
+            self._bytes += n
+            self._expulsar(proteger=(sesion, nombre))
+
+    def obtener(self, sesion, nombre):
+        """Valor guardado o None si nunca se guardó o fue expulsado."""
+        with self._lock:
+            self._expulsar()
+            entrada = self._datos.get((sesion, nombre))
+            if entrada is None:
+                return None
+            entrada[2] = time.monotonic()
+            self._datos.move_to_end((sesion, nombre))
+            return entrada[0]
+
+    def borrar(self, sesion, nombre):
+        with self._lock:
+            self._quitar((sesion, nombre))
+
+    def anotar_recalculo(self):
+        with self._lock:
+            self.recalculos += 1
+
+    def _quitar(self, clave):
+        entrada = self._datos.pop(clave, None)
+        if entrada is not None:
+            self._bytes -= entrada[1]
+        return entrada
+
+    def _expulsar(self, proteger=None):
+        # Primero lo inactivo; después lo menos usado hasta entrar en presupuesto.
+        # La entrada recién guardada nunca se expulsa aunque supere el límite sola.
+        limite = time.monotonic() - self.inactividad_s
+        for clave in [c for c, e in self._datos.items() if e[2] < limite and c != proteger]:
+            self._quitar(clave)
+            self.expulsiones += 1
+        for clave in list(self._datos):
+            if self._bytes <= self.presupuesto:
+                break
+            if clave != proteger:
+                self._quitar(clave)
+                self.expulsiones += 1
+
+    def uso(self, sesion=None):
+        with self._lock:
+            self._expulsar()
+            return {
+                'bytes': self._bytes,
+                'presupuesto': self.presupuesto,
+                'entradas': len(self._datos),
+                'sesiones': len({s for s, _ in self._datos}),
+                'bytes_sesion': sum(e[1] for (s, _), e in self._datos.items() if s == sesion),
+                'expulsiones': self.expulsiones,
+                'recalculos': self.recalculos,
+            }
+
+@st.cache_resource
+def registro_memoria():
+    return RegistroMemoria(PRESUPUESTO_MEMORIA_MB * 1024 ** 2, INACTIVIDAD_MAX_S)
+
+def _id_sesion():
+    if "_memoria_id" not in st.session_state:
+        st.session_state._memoria_id = uuid.uuid4().hex
+    return st.session_state._memoria_id
+
+def guardar_dato(nombre, valor, receta=None):
+    """
+    Guarda valor en el registro y deja en session_state[nombre] solo la
+    receta (fn, args) que lo reconstruye. valor=None borra el dato.
+    """
+    if valor is None:
+        registro_memoria().borrar(_id_sesion(), nombre)
+        st.session_state[nombre] = None
+        return
+    registro_memoria().guardar(_id_sesion(), nombre, valor)
+    st.session_state[nombre] = receta or ()
+
+def leer_dato(nombre):
+    """Valor del dato; si fue expulsado se rehace con su receta (None si no tiene)."""
+    receta = st.session_state.get(nombre)
+    if receta is None:
+        return None
+    registro = registro_memoria()
+    valor = registro.obtener(_id_sesion(), nombre)
+    if valor is None and receta:
+        fn, args = receta
+        with st.spinner(T["reloading_data"]):
+            try:
+                valor = fn(*args)
+            except ErrorDescarga as e:
+                # Se conserva la receta: el próximo rerun vuelve a intentarlo
+                st.error(T["api_error"].format(endpoint="car_data/location", e=e))
+                return None
+        registro.anotar_recalculo()
+        if valor is not None:
+            registro.guardar(_id_sesion(), nombre, valor)
+    if valor is None:
+        st.session_state[nombre] = None
+    return valor
+
+# Recetas: todas tiran de cachés compartidas (índice, cache_data, almacén)
+def vueltas_piloto(year, session_key, driver_number):
+    laps_ses = indice_temporada(year).vueltas_de(session_key)
+    df_l = laps_ses[laps_ses['driver_number'] == driver_number]
+    return None if df_l.empty else df_l.sort_values('lap_number')
+
+def telemetria_vuelta(*args):
+    df = analizar_vuelta(*args)
+    return None if df is None else guardar_telemetria(df, args)
+
+def comparacion_vueltas(peticiones):
+    """peticiones: [(etiqueta, args de vuelta_comparacion)] -> (etiquetas, comparar_vueltas) o None."""
+    vueltas, etiquetas = [], []
+    # Primero todos los análisis: una vuelta más rápida puede sustituir el trazado
+    # y todas las rejillas deben salir del mismo
+    for _, args in peticiones:
+        analizar_vuelta(*args)
+    for etiqueta, args in peticiones:
+        v = vuelta_comparacion(*args)
+        if v is not None:
+            vueltas.append(v)
+            etiquetas.append(etiqueta)
+    return (etiquetas, comparar_vueltas(vueltas)) if vueltas else None
+
+# ─────────────────────────────────────────────
+#  SERVICIO HTTP (API sin interfaz)
+#  Con F1_API_PORT el proceso sirve JSON o Arrow
+#  desde las cachés del pipeline, en hilos propios
+#  y sin el modelo de rerun de Streamlit.
+#  `python f1-explained.py` levanta solo la API.
+# ─────────────────────────────────────────────
+TIPO_ARROW = "application/vnd.apache.arrow.stream"
+ESPERA_INDICE_API_S = 30
+LIMITE_PAGINA = 2000
+LIMITE_PAGINA_MAX = 20000
+MAX_RESPUESTAS_CACHEADAS = 1024
+COLUMNAS_MUESTRAS = ['date', 'dist', 'segmento_id', 'x', 'y', 'speed', 'throttle', 'brake',
+                     'rpm', 'n_gear', 'dt', 'power_w', 'energy_j', 'ia_status_key']
+
+class ErrorApi(Exception):
+    def __init__(self, estado, mensaje):
+        super().__init__(mensaje)
+        self.estado = estado
+
+def _bool_api(valor):
+    return valor.lower() in ("1", "true", "yes")
+
+def _parametro(q, nombre, tipo=int, defecto=None):
+    if nombre not in q:
+        if defecto is None:
+            raise ErrorApi(400, f"missing parameter '{nombre}'")
+        return defecto
+    try:
+        return tipo(q[nombre])
+    except ValueError:
+        raise ErrorApi(400, f"invalid parameter '{nombre}'")
+
+def _motor_api(valor):
+    if valor not in (MOTOR_KMEANS, MOTOR_UMBRALES):
+        raise ValueError(valor)
+    return valor
+
+def _filtros_api(q):
+    return (_parametro(q, 'v_min', int, 0), _parametro(q, 'sampling', int, 1),
+            _parametro(q, 'interpolate', _bool_api, False), _parametro(q, 'engine', _motor_api, MOTOR_KMEANS))
+
+def _vueltas_api(q):
+    """Índice del año, sesión y vueltas del piloto pedidos (404 si no existen)."""
+    year = _parametro(q, 'year', int, TEMPORADAS[-1])
+    # Un índice por año vive para siempre: solo los años soportados
+    if year not in TEMPORADAS:
+        raise ErrorApi(404, f"unsupported year {year}")
+    indice = indice_temporada(year)
+    if not indice.esperar_carga(ESPERA_INDICE_API_S):
+        raise ErrorApi(503, "season index is loading")
+    session_key = _parametro(q, 'session_key')
+    driver_number = _parametro(q, 'driver_number')
+    ses = indice.sesiones_por_key.get(session_key)
+    if ses is None:
+        raise ErrorApi(404, f"unknown session_key {session_key}")
+    laps = indice.vueltas_de(session_key)
+    laps = laps[laps['driver_number'] == driver_number]
+    if laps.empty:
+        raise ErrorApi(404, f"no laps for driver {driver_number}")
+    return ses, laps
+
+def _vuelta_api(q):
+    """Vuelta analizada (cache de analizar_vuelta) y sus argumentos."""
+    ses, laps = _vueltas_api(q)
+    lap_number = _parametro(q, 'lap_number')
+    fila = laps[laps['lap_number'] == lap_number]
+    if fila.empty:
+        raise ErrorApi(404, f"unknown lap {lap_number}")
+    fila = fila.iloc[0]
+    args = (ses['session_key'], int(fila['driver_number']), ses['meeting_key'], fila['date_start'],
+            float(fila['lap_duration'])) + _filtros_api(q)
+    try:
+        df = analizar_vuelta(*args)
+    except ErrorDescarga as e:
+        raise ErrorApi(502, str(e))
+    if df is None or len(df) < 10:
+        raise ErrorApi(404, "no telemetry for this lap")
+    return df, {'session_key': args[0], 'driver_number': args[1], 'lap_number': lap_number,
+                'lap_duration': args[4], 'samples': len(df)}
+
+# Cada endpoint devuelve (tabla, meta, fija); solo las respuestas fijas se cachean
+def api_resumen_vuelta(q):
+    """Balance de la vuelta en meta y, como tabla, totales por fase."""
+    df, meta = _vuelta_api(q)
+    fases = segmentos_fase(df).groupby('status', observed=False).agg(
+        segments=('inicio', 'size'), seconds=('duracion_s', 'sum'), energy_j=('energia_j', 'sum'),
+    ).reset_index()
+    fases['seconds'] = fases['seconds'].astype(float).round(3)
+    fases['energy_mj'] = fases.pop('energy_j') / 1e6
+    return fases, meta | resumen_energia_vuelta(df), True
+
+def api_muestras_vuelta(q):
+    """Muestras de la vuelta con su fase, paginadas con offset/limit."""
+    df, meta = _vuelta_api(q)
+    offset = _parametro(q, 'offset', int, 0)
+    limit = min(_parametro(q, 'limit', int, LIMITE_PAGINA), LIMITE_PAGINA_MAX)
+    if offset < 0 or limit <= 0:
+        raise ErrorApi(400, "offset must be >= 0 and limit > 0")
+    pagina = df[[c for c in COLUMNAS_MUESTRAS if c in df.columns]].iloc[offset:offset + limit]
+    fin = offset + len(pagina)
+    return pagina.reset_index(drop=True), meta | {
+        'total': len(df), 'offset': offset, 'limit': limit,
+        'next_offset': fin if fin < len(df) else None,
+    }, True
+
+def api_tabla_sesion(q):
+    """Tabla de energía de todas las vueltas; 202 con filas parciales mientras se calcula."""
+    ses, laps = _vueltas_api(q)
+    driver_number = int(laps['driver_number'].iloc[0])
+    clave = lanzar_tabla_energia(ses['session_key'], driver_number, laps, *_filtros_api(q),
+                                 meeting_key=ses.get('meeting_key'))
+    estado = tabla_energia(clave)
+    if estado['error'] is not None:
+        raise ErrorApi(502, estado['error'])
+    filas = dict(estado['filas'])
+    resumen = pd.DataFrame.from_dict({n: r for n, r in filas.items() if r is not None}, orient='index',
+                                     columns=['deploy_mj', 'harvest_mj', 'net_mj', 'clipping_s'])
+    tabla = laps[['lap_number', 'lap_duration']].join(resumen, on='lap_number').reset_index(drop=True)
+    completa = tabla_completa(estado)
+    return tabla, {'session_key': ses['session_key'], 'driver_number': driver_number,
+                   'complete': completa, 'laps_done': len(filas), 'laps_total': estado['total'],
+                   'laps_failed': sorted(estado['fallos'])}, completa
+
+RUTAS_API = {
+    "/api/lap/summary": api_resumen_vuelta,
+    "/api/lap/samples": api_muestras_vuelta,
+    "/api/session/energy": api_tabla_sesion,
+}
+
+def _json_api(valor):
+    return valor.item() if hasattr(valor, 'item') else str(valor)
+
+def serializar_api(tabla, meta, arrow):
+    """Arrow IPC stream (meta en los metadatos del esquema) o JSON {"meta", "data"}."""
+    meta_json = json.dumps(meta, default=_json_api)
+    if arrow:
+        t = pa.Table.from_pandas(tabla, preserve_index=False)
+        t = t.replace_schema_metadata((t.schema.metadata or {}) | {b'f1_meta': meta_json.encode()})
+        sink = pa.BufferOutputStream()
+        with pa_ipc.new_stream(sink, t.schema) as w:
+            w.write_table(t)
+        return sink.getvalue().to_pybytes()
+    datos = tabla.to_json(orient='records', date_format='iso', date_unit='ms')
+    return f'{{"meta": {meta_json}, "data": {datos}}}'.encode()
+
+class _ManejadorApi(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive: toda respuesta lleva Content-Length
+    disable_nagle_algorithm = True  # cabeceras y cuerpo van en escrituras separadas
+
+    def do_GET(self):
+        self.server.servicio.atender(self)
+
+    def log_message(self, *args):
+        pass
+
+class ServicioApi:
+    """
+    Servidor HTTP en un hilo daemon. Las respuestas fijas se guardan ya
+    serializadas (LRU) con su ETag y, al pedirse, su versión gzip: una
+    petición repetida no toca pandas.
+    """
+
+    def __init__(self, host, puerto):
+        self._respuestas = OrderedDict()
+        self._lock = threading.Lock()
+        self.servidor = ThreadingHTTPServer((host, puerto), _ManejadorApi)
+        self.servidor.daemon_threads = True
+        self.servidor.servicio = self
+        self._hilo = threading.Thread(target=self.servidor.serve_forever, name="f1-api", daemon=True)
+        self._hilo.start()
+
+    def esperar(self):
+        self._hilo.join()
+
+    def respuesta(self, ruta, q, arrow):
+        clave = (ruta, tuple(sorted(q.items())), arrow)
+        with self._lock:
+            entrada = self._respuestas.get(clave)
+            if entrada is not None:
+                self._respuestas.move_to_end(clave)
+                return entrada
+        tabla, meta, fija = RUTAS_API[ruta](q)
+        cuerpo = serializar_api(tabla, meta, arrow)
+        entrada = {
+            'estado': 200 if fija else 202,
+            'tipo': TIPO_ARROW if arrow else "application/json",
+            'cuerpo': cuerpo,
+            'gzip': None,
+            'etag': '"' + hashlib.sha1(cuerpo).hexdigest() + '"',
+            'fija': fija,
+        }
+        if fija:
+            with self._lock:
+                self._respuestas[clave] = entrada
+                while len(self._respuestas) > MAX_RESPUESTAS_CACHEADAS:
+                    self._respuestas.popitem(last=False)
+        return entrada
+
+    def atender(self, peticion):
+        url = urlsplit(peticion.path)
+        if url.path not in RUTAS_API:
+            return self._enviar(peticion, 404, b'{"error": "not found"}', "application/json")
+        q = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        arrow = TIPO_ARROW in peticion.headers.get('Accept', '')
+        try:
+            entrada = self.respuesta(url.path, q, arrow)
+        except ErrorApi as e:
+            return self._enviar(peticion, e.estado, json.dumps({'error': str(e)}).encode(), "application/json")
+        except Exception as e:
+            return self._enviar(peticion, 500, json.dumps({'error': str(e)}).encode(), "application/json")
+        cabeceras = {
+            'ETag': entrada['etag'],
+            'Vary': "Accept, Accept-Encoding",
+            'Cache-Control': "public, max-age=300" if entrada['fija'] else "no-store",
+        }
+        if entrada['etag'] in peticion.headers.get('If-None-Match', ''):
+            return self._enviar(peticion, 304, b'', None, cabeceras)
+        cuerpo = entrada['cuerpo']
+        if 'gzip' in peticion.headers.get('Accept-Encoding', ''):
+            comprimido = gzip.compress(cuerpo, compresslevel=6) if entrada['gzip'] is None else None
+            with self._lock:
+                if entrada['gzip'] is None:
+                    entrada['gzip'] = comprimido
+                cuerpo = entrada['gzip']
+            cabeceras['Content-Encoding'] = "gzip"
+        self._enviar(peticion, entrada['estado'], cuerpo, entrada['tipo'], cabeceras)
+
+    @staticmethod
+    def _enviar(peticion, estado, cuerpo, tipo, cabeceras=None):
+        peticion.send_response(estado)
+        if tipo is not None:
+            peticion.send_header('Content-Type', tipo)
+        for k, v in (cabeceras or {}).items():
+            peticion.send_header(k, v)
+        peticion.send_header('Content-Length', str(len(cuerpo)))
+        peticion.end_headers()
+        peticion.wfile.write(cuerpo)
+
+@st.cache_resource(show_spinner=False)
+def servicio_api(host, puerto):
+    """
+    Con varios procesos de servidor solo el primero abre el puerto: el resto
+    recibe None (cacheado, no se reintenta en cada rerun) y sigue sirviendo
+    la interfaz. Sin interfaz el puerto es todo el proceso y el error sube.
+    """
+    try:
+        return ServicioApi(host, puerto)
+    except OSError as e:
+        if not st.runtime.exists():
+            raise
+        logging.getLogger(__name__).warning("HTTP API not started on %s:%s: %s", host, puerto, e)
+        return None
+
+if os.environ.get("F1_API_PORT"):
+    _api = servicio_api(os.environ.get("F1_API_HOST", "127.0.0.1"), int(os.environ["F1_API_PORT"]))
+    if not st.runtime.exists():
+        _api.esperar()
+
+# ─────────────────────────────────────────────
+#  ARRAYS COMPACTOS PARA GRÁFICOS
+#  plotly ≥ 6 envía los arrays numpy como typed
+#  arrays base64 con su dtype: float32/int16 en
+#  vez de float64 reduce el payload a la mitad.
+# ─────────────────────────────────────────────
+def compacto(valores, dtype=np.float32):
+    """Array numpy del dtype pedido; los enteros con NaN pasan a float32."""
+    a = np.asarray(valores)
+    if np.issubdtype(dtype, np.integer) and a.dtype.kind == 'f' and np.isnan(a).any():
+        dtype = np.float32
+    return a.astype(dtype, copy=False)
+
 # ─────────────────────────────────────────────
 #  NAVEGACIÓN
 # ─────────────────────────────────────────────
@@ -482,7 +2785,7 @@ with st.sidebar:
     st.title(T["menu_title"])
     v_seleccionada = st.radio(
         T["go_to"],
-        [T["analyzer"], T["faq"]]
+        [T["analyzer"], T["season"], T["faq"]]
     )
     st.divider()
 
@@ -533,9 +2836,12 @@ if v_seleccionada == T["analyzer"]:
     # ── SIDEBAR: solo ajustes técnicos ──────────────────────
     with st.sidebar:
         st.header(T["settings"])
-        year = st.selectbox(T["year"], [2026], index=0)
+        year = st.selectbox(T["year"], TEMPORADAS, index=len(TEMPORADAS) - 1)
         muestreo = st.slider(T["sampling"], 1, 10, 1)
         v_min = st.slider(T["min_speed"], 0, 100, 0)
+        interpolar_pos = st.toggle(T["interpolate_pos"], value=False)
+        motor_opciones = {T["engine_kmeans"]: MOTOR_KMEANS, T["engine_thresholds"]: MOTOR_UMBRALES}
+        motor_fases = motor_opciones[st.selectbox(T["phase_engine"], list(motor_opciones.keys()))]
         circuit_options = {
             T["circuit_normal"]:    8.5,
             T["circuit_limited"]:   8.0,
@@ -545,8 +2851,15 @@ if v_seleccionada == T["analyzer"]:
         ENERGY_LIMIT = circuit_options[sel_circuit]
         st.divider()
         if st.button(T["clear_data"], use_container_width=True):
-            st.session_state.laps_data = None
-            st.session_state.telemetry_data = None
+            guardar_dato("laps_data", None)
+            guardar_dato("telemetry_data", None)
+            st.session_state.pista_data = None
+            guardar_dato("comparison_data", None)
+            st.session_state.lap_energy_key = None
+            if st.session_state.get("analysis_job") is not None:
+                st.session_state.analysis_job.cancelar()
+            st.session_state.analysis_job = None
+            st.session_state.race_sim = None
             st.rerun()
 
     # ── SESSION STATE ────────────────────────────────────────
@@ -554,6 +2867,16 @@ if v_seleccionada == T["analyzer"]:
         st.session_state.laps_data = None
     if "telemetry_data" not in st.session_state:
         st.session_state.telemetry_data = None
+    if "pista_data" not in st.session_state:
+        st.session_state.pista_data = None
+    if "comparison_data" not in st.session_state:
+        st.session_state.comparison_data = None
+    if "lap_energy_key" not in st.session_state:
+        st.session_state.lap_energy_key = None
+    if "analysis_job" not in st.session_state:
+        st.session_state.analysis_job = None
+    if "race_sim" not in st.session_state:
+        st.session_state.race_sim = None
 
     # ── PÁGINA PRINCIPAL ─────────────────────────────────────
     st.title(T["page_title"])
@@ -567,34 +2890,41 @@ if v_seleccionada == T["analyzer"]:
       <div style="flex:1;height:1px;background:#222230"></div>
     </div>""")
 
-    meetings = get_data_api("meetings", {"year": year})
+    # Metadatos desde el índice en memoria; carga y refresco van en segundo plano
+    indice = indice_temporada(year)
+    esperar_indice(indice)
+    meetings = indice.lista_meetings()
     if meetings:
         m_map = {m['meeting_official_name']: m['meeting_key'] for m in meetings}
         c1, c2, c3 = st.columns(3)
         with c1:
             sel_gp = st.selectbox(T["grand_prix"], list(m_map.keys()))
-        s_raw = get_data_api("sessions", {"meeting_key": m_map[sel_gp]})
+        s_raw = indice.sesiones_de(m_map[sel_gp])
         s_map = {s['session_name']: s['session_key'] for s in s_raw}
         with c2:
             sel_session = st.selectbox(T["session"], list(s_map.keys()))
         s_key = s_map[sel_session]
-        d_raw = get_data_api("drivers", {"session_key": s_key})
+        d_raw = indice.pilotos_de(s_key)
         d_map = {f"{d['last_name']} (#{d['driver_number']})": d['driver_number'] for d in d_raw}
         with c3:
             sel_driver_name = st.selectbox(T["driver"], list(d_map.keys()))
-        d_num = d_map[sel_driver_name]
-
-        if st.button(T["load_laps"], type="primary"):
-            laps_raw = get_data_api("laps", {"session_key": s_key, "driver_number": d_num})
-            if laps_raw:
-                df_l = pd.DataFrame(laps_raw).dropna(subset=['date_start', 'lap_duration'])
-                df_l['date_start'] = pd.to_datetime(df_l['date_start'], format='mixed')
-                st.session_state.laps_data = df_l.sort_values('lap_number')
-                st.session_state.telemetry_data = None
+        d_num = d_map.get(sel_driver_name)
+        if d_num is None:
+            st.info(T["drivers_pending"])
+
+        if st.button(T["load_laps"], type="primary", disabled=d_num is None):
+            receta = (vueltas_piloto, (year, s_key, d_num))
+            df_l = vueltas_piloto(*receta[1])
+            if df_l is not None:
+                guardar_dato("laps_data", df_l, receta)
+                guardar_dato("telemetry_data", None)
+                st.session_state.lap_energy_key = lanzar_tabla_energia(
+                    s_key, d_num, df_l, v_min, muestreo, interpolar_pos, motor_fases, m_map[sel_gp])
                 st.success(T["laps_loaded"].format(n=len(df_l)))
 
     # ── PASO 2: Selección de vuelta ──────────────────────────
-    if st.session_state.laps_data is not None:
+    laps_df = leer_dato("laps_data")
+    if laps_df is not None:
         st.html("""<div style="display:flex;align-items:center;gap:12px;margin:16px 0 4px">
           <div style="font-family:'Titillium Web',sans-serif;font-size:11px;font-weight:700;
                       letter-spacing:.25em;color:#E8002D;text-transform:uppercase">
@@ -603,67 +2933,119 @@ if v_seleccionada == T["analyzer"]:
           <div style="flex:1;height:1px;background:#222230"></div>
         </div>""")
 
-        n_laps = len(st.session_state.laps_data)
+        n_laps = len(laps_df)
         st.markdown(
             f"**{sel_driver_name}** · {sel_session} · {sel_gp} · "
             f"<span style='color:#6060A0'>{n_laps} vueltas</span>",
             unsafe_allow_html=True
         )
 
-        def fmt_lap(row):
-            dur = row['lap_duration']
+        def fmt_tiempo(dur):
             try:
                 mins = int(dur) // 60
                 secs = dur - mins * 60
-                t_str = f"{mins}:{secs:06.3f}"
+                return f"{mins}:{secs:06.3f}"
             except Exception:
-                t_str = "–:–––"
-            return f"Vuelta {int(row['lap_number'])}  —  {t_str}"
+                return "–:–––"
+
+        def fmt_lap(lap_number, dur):
+            return f"Vuelta {int(lap_number)}  —  {fmt_tiempo(dur)}"
 
-        laps_df = st.session_state.laps_data
-        lap_options = {fmt_lap(row): row['lap_number'] for _, row in laps_df.iterrows()}
+        lap_options = {fmt_lap(n, dur): n for n, dur in zip(laps_df['lap_number'], laps_df['lap_duration'])}
         col_sel, col_btn = st.columns([3, 1])
         with col_sel:
             sel_label = st.selectbox(T["select_lap"], list(lap_options.keys()),
                                      index=len(lap_options) - 1, label_visibility="collapsed")
         sel_lap = lap_options[sel_label]
+
+        # ── Tabla de energía de todas las vueltas (se rellena en segundo plano)
+        estado_tabla = tabla_energia(st.session_state.lap_energy_key)
+        if estado_tabla is not None:
+            def tabla_energia_vueltas(en_linea):
+                filas = dict(estado_tabla['filas'])
+                completa = tabla_completa(estado_tabla)
+                resumen = pd.DataFrame.from_dict(
+                    {n: r for n, r in filas.items() if r is not None}, orient='index',
+                    columns=['deploy_mj', 'harvest_mj', 'net_mj', 'clipping_s'])
+                tabla = laps_df[['lap_number', 'lap_duration']].join(resumen, on='lap_number')
+                with st.expander(T["lap_energy_title"], expanded=True):
+                    if estado_tabla['error'] is not None:
+                        st.warning(T["lap_energy_error"].format(e=estado_tabla['error']))
+                    elif not completa:
+                        st.caption(T["lap_energy_progress"].format(done=len(filas), total=estado_tabla['total']))
+                    fallos = dict(estado_tabla['fallos'])
+                    if fallos:
+                        st.warning(T["lap_energy_failed"].format(
+                            laps=", ".join(str(n) for n in sorted(fallos)), e=next(iter(fallos.values()))))
+                    st.dataframe(pd.DataFrame({
+                        T["lap"]:        tabla['lap_number'].astype(int),
+                        T["lap_time"]:   tabla['lap_duration'].map(fmt_tiempo),
+                        T["deploy_mj"]:  tabla['deploy_mj'].round(3),
+                        T["harvest_mj"]: tabla['harvest_mj'].round(3),
+                        T["net_mj"]:     tabla['net_mj'].round(3),
+                        T["clipping_s"]: tabla['clipping_s'].round(2),
+                    }), hide_index=True, use_container_width=True)
+                # Al completar, un rerun completo deja de sondear
+                if completa and not en_linea:
+                    st.rerun()
+
+            completa = tabla_completa(estado_tabla)
+            sondear(tabla_energia_vueltas, "_lap_energy_inline", None if completa else 1.0)
         v_info = laps_df[laps_df['lap_number'] == sel_lap].iloc[0]
         with col_btn:
             do_analyze = st.button(T["analyze_lap"], type="primary", use_container_width=True)
 
+        # ── Trabajo de análisis: se cancela si el usuario cambia de vuelta
+        vuelta_actual = (s_key, d_num, int(sel_lap))
+        trabajo = st.session_state.analysis_job
+        if trabajo is not None and not trabajo.terminado and trabajo.meta['vuelta'] != vuelta_actual:
+            trabajo.cancelar()
+            st.session_state.analysis_job = trabajo = None
+
         if do_analyze:
-            with st.spinner(T["analyzing"]):
-                t_start = v_info['date_start']
-                t_end = t_start + pd.Timedelta(seconds=v_info['lap_duration'] + 0.8)
-                params = {
-                    "session_key": s_key,
-                    "driver_number": d_num,
-                    "date>": t_start.isoformat(),
-                    "date<": t_end.isoformat()
-                }
-                c_raw = get_data_api("car_data", params)
-                l_raw = get_data_api("location", params)
-                if c_raw and l_raw:
-                    df = pd.merge_asof(
-                        pd.DataFrame(c_raw)
-                          .assign(date=lambda x: pd.to_datetime(x['date'], format='mixed'))
-                          .sort_values('date'),
-                        pd.DataFrame(l_raw)
-                          .assign(date=lambda x: pd.to_datetime(x['date'], format='mixed'))
-                          .sort_values('date')[['date', 'x', 'y']],
-                        on='date', direction='nearest', tolerance=pd.Timedelta(seconds=1)
-                    )
-                    if v_min > 0:
-                        df = df[df['speed'] >= v_min]
-                    if muestreo > 1:
-                        df = df.iloc[::muestreo]
-                    st.session_state.telemetry_data = (
-                        df.dropna(subset=['x', 'y'])
-                          .pipe(aplicar_ia_f1)
-                          .pipe(calcular_energia_2026)
-                    )
-
-    if st.session_state.telemetry_data is not None:
+            if trabajo is not None:
+                trabajo.cancelar()
+            args = (s_key, d_num, m_map[sel_gp], v_info['date_start'],
+                    float(v_info['lap_duration']), v_min, muestreo, interpolar_pos, motor_fases)
+            st.session_state.analysis_job = Trabajo(
+                trabajo_analisis, *args,
+                meta={'vuelta': vuelta_actual, 'meeting_key': m_map[sel_gp], 'args': args},
+            )
+
+        if st.session_state.analysis_job is not None:
+            def progreso_analisis(en_linea):
+                trabajo = st.session_state.analysis_job
+                if trabajo is None:
+                    return
+                if not trabajo.terminado:
+                    st.progress(trabajo.progreso, text=f"{T['analyzing']} {T[trabajo.etapa]}")
+                    return
+                # Entregar el resultado a session_state; la sección de análisis se
+                # dibuja más abajo, así que solo hace falta rerun desde el fragmento
+                df = trabajo.resultado()
+                st.session_state.analysis_job = None
+                if df is not None:
+                    st.session_state.pista_data = pista_referencia(
+                        trabajo.meta['meeting_key'], df['x'].to_numpy(), df['y'].to_numpy())
+                    guardar_dato("telemetry_data", guardar_telemetria(df, trabajo.meta['args']),
+                                 (telemetria_vuelta, trabajo.meta['args']))
+                elif trabajo.error is not None:
+                    st.session_state.analysis_error = str(trabajo.error)
+                elif not trabajo.cancelado:
+                    # El hilo del pool no tiene ScriptRunContext: todo aviso se da aquí
+                    st.session_state.analysis_empty = True
+                if not en_linea:
+                    st.rerun()
+
+            sondear(progreso_analisis, "_analysis_inline", 0.5)
+
+        if st.session_state.get("analysis_error"):
+            st.error(T["api_error"].format(endpoint="car_data/location", e=st.session_state.pop("analysis_error")))
+        if st.session_state.pop("analysis_empty", False):
+            st.warning(T["no_telemetry"])
+
+    df_p = leer_telemetria(leer_dato("telemetry_data"))
+    if df_p is not None:
         st.html("""<div style="display:flex;align-items:center;gap:12px;margin:16px 0 4px">
           <div style="font-family:'Titillium Web',sans-serif;font-size:11px;font-weight:700;
                       letter-spacing:.25em;color:#E8002D;text-transform:uppercase">
@@ -671,11 +3053,10 @@ if v_seleccionada == T["analyzer"]:
           </div>
           <div style="flex:1;height:1px;background:#222230"></div>
         </div>""")
-        df_p = st.session_state.telemetry_data
         # Usar ia_status_key (clave fija) para la lógica de energía
-        rachas = df_p.groupby('racha_id').agg({'ia_status_key': 'first', 'energy_j': 'sum'}).reset_index()
-        gasto = rachas[rachas['ia_status_key'] == IA_DEPLOYMENT]['energy_j'].sum() / 1e6
-        carga = abs(rachas[rachas['ia_status_key'] == IA_HARVESTING]['energy_j'].sum() / 1e6)
+        rachas = segmentos_fase(df_p)
+        gasto = rachas.loc[rachas['status'] == IA_DEPLOYMENT, 'energia_j'].sum() / 1e6
+        carga = abs(rachas.loc[rachas['status'] == IA_HARVESTING, 'energia_j'].sum() / 1e6)
 
         LIMIT = ENERGY_LIMIT
         balance = gasto - carga
@@ -880,40 +3261,41 @@ if v_seleccionada == T["analyzer"]:
 
         # ── Trazado base del circuito (línea gris muy tenue)
         fig.add_trace(go.Scatter(
-            x=df_sorted['x'], y=df_sorted['y'],
+            x=compacto(df_sorted['x']), y=compacto(df_sorted['y']),
             mode='lines',
             line=dict(color='rgba(255,255,255,0.07)', width=8),
             hoverinfo='skip', showlegend=False, name='_track'
         ))
 
-        # ── Puntos por estado con hover rico
+        # ── Tramos por estado (líneas por segmento RLE) con hover rico. Los valores
+        # del hover viajan como customdata numérico (typed array) y el texto lo
+        # compone el navegador con hovertemplate, en vez de un string por punto.
+        t_p = fechas_ns(df_p['date'])
+        canales_hover = [(t_p - t_p[0]) / 1e9, df_p['rpm'], df_p['speed']]
+        plantilla_hover = ("⏱ %{customdata[0]:.3f} s<br>"
+                           "⚡ " + T["rpm"] + ": %{customdata[1]:.0f}<br>"
+                           "🏎 " + T["vel"] + ": <b>%{customdata[2]:.0f} km/h</b>")
+        for col, etiqueta in (('n_gear', "⚙ Gear"), ('drs', "📡 DRS")):
+            if col in df_p.columns:
+                plantilla_hover += f"<br>{etiqueta}: %{{customdata[{len(canales_hover)}]:.0f}}"
+                canales_hover.append(df_p[col])
+        datos_hover = compacto(np.column_stack(canales_hover))
+        xs, ys = compacto(df_p['x']), compacto(df_p['y'])
         for key, color in clrs.items():
             stts = T[key]
-            m = df_p['ia_status_key'] == key
-            if not m.any():
+            seg_k = rachas[rachas['status'] == key]
+            if seg_k.empty:
                 continue
-            sub = df_p.loc[m]
-            gear_col = sub['n_gear'].astype(str) if 'n_gear' in sub.columns else None
-            drs_col  = sub['drs'].astype(str)    if 'drs'    in sub.columns else None
-
-            hover_lines = (
-                "<b style='color:" + color + "'>" + stts + "</b><br>" +
-                "🕐 " + sub['date'].dt.strftime('%H:%M:%S.%f').str[:-3] + "<br>" +
-                "⚡ " + T["rpm"] + ": " + sub['rpm'].astype(str) + "<br>" +
-                "🏎 " + T["vel"] + ": <b>" + sub['speed'].astype(str) + " km/h</b>" +
-                ("<br>⚙ Gear: " + gear_col if gear_col is not None else "") +
-                ("<br>📡 DRS: "  + drs_col  if drs_col  is not None else "")
-            )
+            idx = indices_trazo(seg_k, len(df_p))
+            corte = idx < 0
 
             fig.add_trace(go.Scatter(
-                x=sub['x'], y=sub['y'],
-                mode='markers', name=stts,
-                hovertext=hover_lines, hoverinfo='text',
-                marker=dict(
-                    color=color, size=7,
-                    line=dict(width=0),
-                    opacity=0.92,
-                )
+                x=np.where(corte, np.nan, xs[idx]), y=np.where(corte, np.nan, ys[idx]),
+                mode='lines', name=stts,
+                customdata=datos_hover[np.maximum(idx, 0)],
+                hovertemplate="<b style='color:" + color + "'>" + stts + "</b><br>" + plantilla_hover + "<extra></extra>",
+                line=dict(color=color, width=5),
+                opacity=0.92,
             ))
 
         # ── Bandera a cuadros: marcador especial en el punto de inicio
@@ -974,6 +3356,34 @@ if v_seleccionada == T["analyzer"]:
         )
         st.plotly_chart(fig, use_container_width=True)
 
+        # ── Energía por segmento (curvas / rectas) ──────────────
+        pista = st.session_state.pista_data
+        if pista is not None and 'segmento_id' in df_p.columns:
+            seg = energia_por_segmento(df_p, pista)
+            seg_tabla = pd.DataFrame({
+                T["segment"]:    seg['tipo'].map(T) + " " + seg['numero'].astype(str),
+                T["dist_start"]: seg['dist_inicio'].round(0),
+                T["dist_end"]:   seg['dist_fin'].round(0),
+                T["deploy_mj"]:  seg['deploy_mj'].round(3),
+                T["harvest_mj"]: seg['harvest_mj'].round(3),
+                T["clipping_s"]: seg['clipping_s'].round(2),
+            })
+            with st.expander(T["segments_title"]):
+                st.dataframe(seg_tabla, hide_index=True, use_container_width=True)
+
+        with st.expander(T["agreement_title"]):
+            # KMeans + calibración cuestan: solo a petición (el expander se ejecuta aunque esté cerrado)
+            if st.toggle(T["agreement_compute"], key="agreement_on"):
+                conc = concordancia_vuelta(df_p)
+                c1, c2 = st.columns(2)
+                c1.metric(T["agreement_default"], f"{conc['defecto']['acierto']:.1%}")
+                c2.metric(T["agreement_calibrated"], f"{conc['calibrado']['acierto']:.1%}")
+                tabla = conc['defecto']['tabla']
+                st.caption(T["agreement_table"])
+                st.dataframe(tabla.rename(index=T, columns=T), use_container_width=True)
+                st.caption(T["calibrated_thresholds"] + " · " +
+                           " · ".join(f"{k} = {v:g}" for k, v in conc['calibrados'].items()))
+
         # ─────────────────────────────────────────────────────────
         # GRÁFICOS DE TELEMETRÍA TEMPORAL
         # ─────────────────────────────────────────────────────────
@@ -989,125 +3399,373 @@ if v_seleccionada == T["analyzer"]:
         df_sorted = df_p.sort_values('date').reset_index(drop=True)
         df_sorted['time_delta'] = (df_sorted['date'] - df_sorted['date'].iloc[0]).dt.total_seconds()
 
-        # Layout común para todos los gráficos
-        common_layout = dict(
-            plot_bgcolor='#05050D',
-            paper_bgcolor='#05050D',
-            height=220,
-            margin=dict(l=50, r=20, t=30, b=40),
-            font=dict(color='white', family='monospace', size=11),
-            xaxis=dict(
-                title='Tiempo (s)',
-                gridcolor='#1a1a28',
-                showgrid=True,
-                zeroline=False,
-            ),
-            hovermode='x unified',
-        )
+        # Una sola figura con eje X compartido: el zoom/pan de una fila mueve todas
+        hay_marcha = 'n_gear' in df_sorted.columns
+        titulos = ['Velocidad (km/h)', 'RPM', 'Acelerador / Freno (%)'] + (['Marcha'] if hay_marcha else []) \
+            + ['Potencia MGU-K (kW)', 'Energía acumulada (MJ)']
+        alturas = [0.22, 0.14, 0.18] + ([0.1] if hay_marcha else []) + [0.18, 0.16]
+        fila_potencia = 5 if hay_marcha else 4
+        fig_tel = make_subplots(rows=len(titulos), cols=1, shared_xaxes=True, vertical_spacing=0.035,
+                                subplot_titles=titulos, row_heights=alturas)
+        t_rel = compacto(df_sorted['time_delta'])
 
         # ── VELOCIDAD ────────────────────────────────────────────
-        fig_speed = go.Figure()
-        fig_speed.add_trace(go.Scatter(
-            x=df_sorted['time_delta'],
-            y=df_sorted['speed'],
-            mode='lines',
-            name='Velocidad',
-            line=dict(color='#00D4FF', width=2),
-            fill='tozeroy',
-            fillcolor='rgba(0,212,255,0.1)',
-        ))
-        fig_speed.update_layout(
-            **common_layout,
-            title='Velocidad',
-            yaxis=dict(title='km/h', gridcolor='#1a1a28'),
+        fig_tel.add_trace(go.Scatter(
+            x=t_rel, y=compacto(df_sorted['speed'], np.int16), mode='lines', name='Velocidad',
+            line=dict(color='#00D4FF', width=2), fill='tozeroy', fillcolor='rgba(0,212,255,0.1)',
             showlegend=False,
-        )
+        ), row=1, col=1)
 
         # ── RPM ──────────────────────────────────────────────────
-        fig_rpm = go.Figure()
-        fig_rpm.add_trace(go.Scatter(
-            x=df_sorted['time_delta'],
-            y=df_sorted['rpm'],
-            mode='lines',
-            name='RPM',
-            line=dict(color='#FF6B00', width=2),
-            fill='tozeroy',
-            fillcolor='rgba(255,107,0,0.1)',
-        ))
-        fig_rpm.update_layout(
-            **common_layout,
-            title='RPM',
-            yaxis=dict(title='RPM', gridcolor='#1a1a28'),
+        fig_tel.add_trace(go.Scatter(
+            x=t_rel, y=compacto(df_sorted['rpm'], np.int16), mode='lines', name='RPM',
+            line=dict(color='#FF6B00', width=2), fill='tozeroy', fillcolor='rgba(255,107,0,0.1)',
             showlegend=False,
-        )
-
-        # ── THROTTLE / BRAKE ─────────────────────────────────────
-        fig_pedals = go.Figure()
-        # Throttle en verde
-        fig_pedals.add_trace(go.Scatter(
-            x=df_sorted['time_delta'],
-            y=df_sorted['throttle'],
-            mode='lines',
-            name='Acelerador',
-            line=dict(color='#00FF88', width=2),
-            fill='tozeroy',
-            fillcolor='rgba(0,255,136,0.15)',
-        ))
-        # Brake en rojo (negativo)
-        fig_pedals.add_trace(go.Scatter(
-            x=df_sorted['time_delta'],
-            y=-df_sorted['brake'],
-            mode='lines',
-            name='Freno',
-            line=dict(color='#FF2200', width=2),
-            fill='tozeroy',
-            fillcolor='rgba(255,34,0,0.15)',
-        ))
-        fig_pedals.update_layout(
-            **common_layout,
-            title='Acelerador / Freno',
-            yaxis=dict(title='% (↑Accel ↓Freno)', gridcolor='#1a1a28'),
-            legend=dict(orientation='h', y=1.1, x=0.5, xanchor='center', font=dict(size=10)),
-        )
+        ), row=2, col=1)
+
+        # ── THROTTLE / BRAKE (freno en negativo) ─────────────────
+        fig_tel.add_trace(go.Scatter(
+            x=t_rel, y=compacto(df_sorted['throttle'], np.int16), mode='lines', name='Acelerador',
+            line=dict(color='#00FF88', width=2), fill='tozeroy', fillcolor='rgba(0,255,136,0.15)',
+        ), row=3, col=1)
+        fig_tel.add_trace(go.Scatter(
+            x=t_rel, y=-compacto(df_sorted['brake'], np.int16), mode='lines', name='Freno',
+            line=dict(color='#FF2200', width=2), fill='tozeroy', fillcolor='rgba(255,34,0,0.15)',
+        ), row=3, col=1)
 
         # ── MARCHAS ──────────────────────────────────────────────
-        if 'n_gear' in df_sorted.columns:
-            fig_gear = go.Figure()
-            fig_gear.add_trace(go.Scatter(
-                x=df_sorted['time_delta'],
-                y=df_sorted['n_gear'],
-                mode='lines',
-                name='Marcha',
-                line=dict(color='#FFD600', width=3, shape='hv'),
-            ))
-            fig_gear.update_layout(
-                **common_layout,
-                title='Marcha',
-                yaxis=dict(
-                    title='Gear',
-                    gridcolor='#1a1a28',
-                    dtick=1,
-                    range=[0, 9],
-                ),
-                showlegend=False,
-            )
+        if hay_marcha:
+            fig_tel.add_trace(go.Scatter(
+                x=t_rel, y=compacto(df_sorted['n_gear'], np.int16), mode='lines', name='Marcha',
+                line=dict(color='#FFD600', width=3, shape='hv'), showlegend=False,
+            ), row=4, col=1)
+            fig_tel.update_yaxes(dtick=1, range=[0, 9], row=4, col=1)
+
+        # ── POTENCIA Y ENERGÍA ACUMULADA (modelo 2026) ───────────
+        fig_tel.add_trace(go.Scatter(
+            x=t_rel, y=compacto(df_sorted['power_w'] / 1000), mode='lines', name='Potencia',
+            line=dict(color='#DD00FF', width=2), fill='tozeroy', fillcolor='rgba(221,0,255,0.12)',
+            showlegend=False,
+        ), row=fila_potencia, col=1)
+        fig_tel.add_trace(go.Scatter(
+            x=t_rel, y=compacto(df_sorted['energy_j'].cumsum() / 1e6), mode='lines', name='Energía',
+            line=dict(color='#FFFFFF', width=2), showlegend=False,
+        ), row=fila_potencia + 1, col=1)
 
-        # ── RENDERIZAR GRÁFICOS ──────────────────────────────────
-        col1, col2 = st.columns(2)
-        with col1:
-            st.plotly_chart(fig_speed, use_container_width=True)
-            st.plotly_chart(fig_pedals, use_container_width=True)
-        with col2:
-            st.plotly_chart(fig_rpm, use_container_width=True)
-            if 'n_gear' in df_sorted.columns:
-                st.plotly_chart(fig_gear, use_container_width=True)
+        fig_tel.update_layout(
+            plot_bgcolor='#05050D',
+            paper_bgcolor='#05050D',
+            height=170 * len(titulos),
+            margin=dict(l=50, r=20, t=40, b=40),
+            font=dict(color='white', family='monospace', size=11),
+            hovermode='x unified',
+            hoversubplots='axis',
+            legend=dict(orientation='h', y=1.04, x=0.5, xanchor='center', font=dict(size=10)),
+        )
+        fig_tel.update_xaxes(gridcolor='#1a1a28', showgrid=True, zeroline=False)
+        fig_tel.update_yaxes(gridcolor='#1a1a28')
+        fig_tel.update_xaxes(title_text='Tiempo (s)', row=len(titulos), col=1)
+        st.plotly_chart(fig_tel, use_container_width=True)
 
 
         # Widget de energía DEBAJO del mapa
         st.html(html_widget)
 
+        # ── Barrido what-if sobre la vuelta analizada ───────────
+        with st.expander(T["sweep_title"]):
+            nombres_param = [k for k in PARAMS_ENERGIA_2026 if k != 'energy_limit_mj']
+            c1, c2, c3, c4 = st.columns(4)
+            with c1:
+                p_x = st.selectbox(T["sweep_param"], nombres_param)
+            with c2:
+                p_y = st.selectbox(T["sweep_param2"], [T["sweep_none"]] + [k for k in nombres_param if k != p_x])
+            with c3:
+                r0, r1 = st.slider(T["sweep_range"], 0.5, 1.5, (0.7, 1.3), step=0.05)
+            with c4:
+                n_pasos = st.slider(T["sweep_steps"], 5, 100, 25)
+            rangos = {p_x: np.linspace(PARAMS_ENERGIA_2026[p_x] * r0, PARAMS_ENERGIA_2026[p_x] * r1, n_pasos)}
+            if p_y != T["sweep_none"]:
+                rangos[p_y] = np.linspace(PARAMS_ENERGIA_2026[p_y] * r0, PARAMS_ENERGIA_2026[p_y] * r1, n_pasos)
+            else:
+                rangos['energy_limit_mj'] = [8.5, 8.0, 5.0]
+            barrido = barrido_parametros({'lap': df_p}, rejilla_parametros(**rangos))
+
+            fig_sw = go.Figure()
+            if p_y != T["sweep_none"]:
+                mapa = barrido.pivot_table(index=p_y, columns=p_x, values='net_mj')
+                fig_sw.add_trace(go.Heatmap(x=mapa.columns, y=mapa.index, z=mapa.values,
+                                            colorscale='RdYlGn_r', colorbar=dict(title=T["net_mj"])))
+                fig_sw.update_layout(xaxis=dict(title=p_x), yaxis=dict(title=p_y))
+            else:
+                base = barrido[barrido['energy_limit_mj'] == 8.5]
+                fig_sw.add_trace(go.Scatter(x=base[p_x], y=base['deploy_mj'], mode='lines', name=T["deploy_mj"],
+                                            line=dict(color='#FF2200', width=2)))
+                fig_sw.add_trace(go.Scatter(x=base[p_x], y=base['harvest_mj'], mode='lines', name=T["harvest_mj"],
+                                            line=dict(color='#00FF88', width=2)))
+                fig_sw.add_trace(go.Scatter(x=base[p_x], y=base['net_mj'], mode='lines', name=T["net_mj"],
+                                            line=dict(color='#FFD600', width=2, dash='dot')))
+                fig_sw.update_layout(xaxis=dict(title=p_x, gridcolor='#1a1a28'),
+                                     yaxis=dict(title='MJ', gridcolor='#1a1a28'))
+            fig_sw.update_layout(
+                plot_bgcolor='#05050D',
+                paper_bgcolor='#05050D',
+                height=380,
+                margin=dict(l=50, r=20, t=30, b=40),
+                font=dict(color='white', family='monospace', size=11),
+                legend=dict(orientation='h', y=1.1, x=0.5, xanchor='center', font=dict(size=10)),
+            )
+            st.plotly_chart(fig_sw, use_container_width=True)
+            st.dataframe(barrido.drop(columns=['vuelta']), hide_index=True, use_container_width=True)
+
+    # ── PASO 4: Comparación multi-vuelta / multi-piloto ─────
+    if laps_df is not None:
+        st.html("""<div style="display:flex;align-items:center;gap:12px;margin:32px 0 4px">
+          <div style="font-family:'Titillium Web',sans-serif;font-size:11px;font-weight:700;
+                      letter-spacing:.25em;color:#E8002D;text-transform:uppercase">
+            <span style="display:inline-flex;align-items:center;justify-content:center;width:18px;height:18px;border:1.5px solid #E8002D;border-radius:50%;font-size:10px;font-weight:700;margin-right:8px;flex-shrink:0">4</span>""" + T["compare_title"] + """
+          </div>
+          <div style="flex:1;height:1px;background:#222230"></div>
+        </div>""")
+        laps_ses = indice.vueltas_de(s_key)
+        lap_nums = sorted(int(n) for n in laps_ses['lap_number'].unique())
+        c1, c2, c3 = st.columns([2, 2, 1])
+        with c1:
+            cmp_drivers = st.multiselect(T["compare_drivers"], list(d_map.keys()), default=[sel_driver_name])
+        with c2:
+            cmp_laps = st.multiselect(T["compare_laps"], lap_nums,
+                                      default=[int(sel_lap)] if int(sel_lap) in lap_nums else [])
+        with c3:
+            st.write("")
+            do_compare = st.button(T["compare_btn"], use_container_width=True)
+
+        if do_compare:
+            peticiones = []
+            for name in cmp_drivers:
+                for lap in cmp_laps:
+                    fila = laps_ses[(laps_ses['driver_number'] == d_map[name]) & (laps_ses['lap_number'] == lap)]
+                    if fila.empty:
+                        continue
+                    fila = fila.iloc[0]
+                    peticiones.append((f"{name} · V{lap}", (s_key, d_map[name], m_map[sel_gp], fila['date_start'],
+                                                            float(fila['lap_duration']), v_min, muestreo,
+                                                            interpolar_pos, motor_fases)))
+            with st.spinner(T["analyzing"]):
+                try:
+                    guardar_dato("comparison_data", comparacion_vueltas(peticiones),
+                                 (comparacion_vueltas, (peticiones,)))
+                except ErrorDescarga as e:
+                    st.error(T["api_error"].format(endpoint="car_data/location", e=e))
+
+        comparacion = leer_dato("comparison_data")
+        if comparacion is not None:
+            etiquetas, cmp = comparacion
+            st.caption(T["compare_ref"].format(ref=etiquetas[0]))
+            fig_cmp = make_subplots(rows=3, cols=1, shared_xaxes=True, vertical_spacing=0.04,
+                                    subplot_titles=(T["speed_kmh"], T["delta_time"], T["delta_energy"]))
+            paleta = ['#00D4FF', '#FF6B00', '#00FF88', '#FFD600', '#DD00FF', '#FF2200', '#CCCCCC']
+            dist_cmp = compacto(cmp['dist'])
+            for i, label in enumerate(etiquetas):
+                color = paleta[i % len(paleta)]
+                fig_cmp.add_trace(go.Scatter(x=dist_cmp, y=compacto(cmp['speed'][i]), mode='lines', name=label,
+                                             legendgroup=label, line=dict(color=color, width=2)), row=1, col=1)
+                fig_cmp.add_trace(go.Scatter(x=dist_cmp, y=compacto(cmp['delta_tiempo_s'][i]), mode='lines', name=label,
+                                             legendgroup=label, showlegend=False, line=dict(color=color, width=2)), row=2, col=1)
+                fig_cmp.add_trace(go.Scatter(x=dist_cmp, y=compacto(cmp['delta_energia_acum_j'][i] / 1e6), mode='lines', name=label,
+                                             legendgroup=label, showlegend=False, line=dict(color=color, width=2)), row=3, col=1)
+            fig_cmp.update_layout(
+                plot_bgcolor='#05050D',
+                paper_bgcolor='#05050D',
+                height=720,
+                margin=dict(l=50, r=20, t=40, b=40),
+                font=dict(color='white', family='monospace', size=11),
+                hovermode='x unified',
+                legend=dict(orientation='h', y=1.06, x=0.5, xanchor='center', font=dict(size=10)),
+            )
+            fig_cmp.update_xaxes(gridcolor='#1a1a28', zeroline=False)
+            fig_cmp.update_yaxes(gridcolor='#1a1a28')
+            fig_cmp.update_xaxes(title_text=T["distance"], row=3, col=1)
+            st.plotly_chart(fig_cmp, use_container_width=True)
+
+    # ── PASO 5: Simulación de batería en carrera ─────────────
+    if laps_df is not None:
+        st.html("""<div style="display:flex;align-items:center;gap:12px;margin:32px 0 4px">
+          <div style="font-family:'Titillium Web',sans-serif;font-size:11px;font-weight:700;
+                      letter-spacing:.25em;color:#E8002D;text-transform:uppercase">
+            <span style="display:inline-flex;align-items:center;justify-content:center;width:18px;height:18px;border:1.5px solid #E8002D;border-radius:50%;font-size:10px;font-weight:700;margin-right:8px;flex-shrink:0">5</span>""" + T["race_title"] + """
+          </div>
+          <div style="flex:1;height:1px;background:#222230"></div>
+        </div>""")
+        if st.button(T["race_btn"]):
+            laps_ses = indice.vueltas_de(s_key)
+            nombres = {num: name for name, num in d_map.items()}
+            st.session_state.race_sim = {
+                'session_key': s_key,
+                'claves': {
+                    nombres.get(dn, str(dn)): lanzar_tabla_energia(s_key, dn, laps_d, v_min, muestreo, interpolar_pos,
+                                                                   motor_fases, m_map[sel_gp])
+                    for dn, laps_d in laps_ses.groupby('driver_number')
+                },
+            }
+
+        race_sim = st.session_state.race_sim
+        if race_sim is not None and race_sim['session_key'] == s_key:
+            def simulacion_carrera(en_linea):
+                estados = {name: tabla_energia(clave) for name, clave in race_sim['claves'].items()}
+                if any(e is None for e in estados.values()):
+                    # Alguna tabla se expulsó de la caché: hay que volver a lanzarla
+                    st.session_state.race_sim = None
+                    if not en_linea:
+                        st.rerun()
+                    return
+                if not all(tabla_completa(e) for e in estados.values()):
+                    done = sum(len(e['filas']) for e in estados.values() if e is not None)
+                    total = sum(e['total'] for e in estados.values() if e is not None)
+                    st.progress(done / max(total, 1), text=T["race_progress"].format(done=done, total=total))
+                    return
+                if not en_linea:
+                    st.rerun()
+                sim = simulacion_carrera_cacheada(
+                    tuple(sorted(race_sim['claves'].items())), ENERGY_LIMIT,
+                    {name: dict(e['potencias']) for name, e in estados.items() if e['potencias']},
+                )
+                fig_soc = go.Figure()
+                for name, g in sim.groupby('driver_number', sort=False):
+                    fig_soc.add_trace(go.Scatter(x=g['lap_number'], y=g['soc_fin_mj'], mode='lines', name=name))
+                fig_soc.update_layout(
+                    plot_bgcolor='#05050D',
+                    paper_bgcolor='#05050D',
+                    height=420,
+                    margin=dict(l=50, r=20, t=40, b=40),
+                    font=dict(color='white', family='monospace', size=11),
+                    title=T["race_soc"],
+                    xaxis=dict(title=T["lap"], gridcolor='#1a1a28', zeroline=False),
+                    yaxis=dict(title='MJ', gridcolor='#1a1a28', range=[0, CAPACIDAD_BATERIA_MJ * 1.05]),
+                    hovermode='x unified',
+                )
+                st.plotly_chart(fig_soc, use_container_width=True)
+                por_piloto = sim.groupby('driver_number').agg(
+                    soc=('soc_fin_mj', 'last'),
+                    vueltas=('starved_s', lambda s: int((s > 0).sum())),
+                    starved_s=('starved_s', 'sum'),
+                    wasted=('wasted_mj', 'sum'),
+                ).reset_index()
+                st.dataframe(pd.DataFrame({
+                    T["driver"]:            por_piloto['driver_number'],
+                    T["race_final_soc"]:    por_piloto['soc'].round(2),
+                    T["race_starved_laps"]: por_piloto['vueltas'],
+                    T["race_starved_s"]:    por_piloto['starved_s'].round(1),
+                    T["race_wasted"]:       por_piloto['wasted'].round(2),
+                }), hide_index=True, use_container_width=True)
+
+            completa = all(tabla_completa(tabla_energia(c)) for c in race_sim['claves'].values())
+            sondear(simulacion_carrera, "_race_inline", None if completa else 1.0)
+
+    # ── Instrumentación: memoria de datos de sesión (al final, tras las lecturas)
+    with st.sidebar:
+        uso = registro_memoria().uso(_id_sesion())
+        with st.expander(T["instrumentation"]):
+            st.progress(min(uso['bytes'] / uso['presupuesto'], 1.0),
+                        text=T["mem_used"].format(usado=uso['bytes'] / 1024 ** 2, total=uso['presupuesto'] / 1024 ** 2))
+            st.caption(T["mem_stats"].format(**uso, propio=uso['bytes_sesion'] / 1024 ** 2))
+
+# ─────────────────────────────────────────────
+#  VISTA 2: TEMPORADA (agregados materializados)
+# ─────────────────────────────────────────────
+elif v_seleccionada == T["season"]:
+    with st.sidebar:
+        st.header(T["settings"])
+        year = st.selectbox(T["year"], TEMPORADAS, index=len(TEMPORADAS) - 1)
+        motor_opciones = {T["engine_kmeans"]: MOTOR_KMEANS, T["engine_thresholds"]: MOTOR_UMBRALES}
+        motor_fases = motor_opciones[st.selectbox(T["phase_engine"], list(motor_opciones.keys()))]
+
+    st.title(T["season_title"])
+    indice = indice_temporada(year)
+    indice_listo = esperar_indice(indice)
+    agregados = agregados_temporada()
+    t_consulta = time.perf_counter()
+    resumen = agregados.resumen(motor_fases)
+    resumen = resumen[resumen['meeting_key'].isin(indice.meetings)]
+    if agregados.ultimo_error:
+        st.warning(T["season_db_error"].format(e=agregados.ultimo_error))
+    if not indice_listo:
+        pass    # esperar_indice ya muestra el aviso de carga
+    elif resumen.empty:
+        st.info(T["season_empty"])
+    else:
+        nombres_gp = {k: m['meeting_official_name'] for k, m in indice.meetings.items()}
+        nombres_piloto = {d['driver_number']: f"{d['last_name']} (#{d['driver_number']})"
+                          for pilotos in indice.pilotos.values() for d in pilotos}
+        pilotos = agregados.por_piloto(resumen['meeting_key'].tolist(), motor_fases)
+        gp_opciones = {nombres_gp[k]: k for k in resumen['meeting_key']}
+        sel_gp = st.selectbox(T["grand_prix"], list(gp_opciones.keys()))
+        segmentos = agregados.por_segmento(gp_opciones[sel_gp], motor_fases)
+        vueltas_gp = agregados.vueltas_de(gp_opciones[sel_gp], motor_fases)
+        ms = (time.perf_counter() - t_consulta) * 1e3
+        st.caption(T["season_stored"].format(laps=int(resumen['vueltas'].sum()), circuits=len(resumen), ms=ms))
+
+        # ── Pilotos: media por vuelta en toda la temporada ──────
+        st.subheader(T["season_drivers"])
+        st.dataframe(pd.DataFrame({
+            T["driver"]:           pilotos['driver_number'].map(lambda n: nombres_piloto.get(n, f"#{n}")),
+            T["laps_count"]:       pilotos['vueltas'],
+            T["harvest_mj"]:       pilotos['harvest_mj'].round(3),
+            T["deploy_mj"]:        pilotos['deploy_mj'].round(3),
+            T["clipping_s"]:       pilotos['clipping_s'].round(2),
+            T["clipping_events"]:  pilotos['n_clipping'].round(2),
+            T["v_clipping_onset"]: pilotos['v_clipping_max'].round(0),
+        }), hide_index=True, use_container_width=True)
+
+        # ── Circuito: dónde se produce el clipping ──────────────
+        st.subheader(T["season_segments"])
+        etiquetas = segmentos['tipo'].map(T) + " " + segmentos['numero'].astype(str)
+        fig_temp = make_subplots(specs=[[{"secondary_y": True}]])
+        fig_temp.add_trace(go.Bar(
+            x=etiquetas, y=compacto(segmentos['clipping_s']), name=T["clipping_s"],
+            marker_color=np.where(segmentos['tipo'] == SEG_RECTA, '#FFD600', '#6060A0'),
+        ))
+        fig_temp.add_trace(go.Scatter(
+            x=etiquetas, y=compacto(segmentos['v_clipping_max']), name=T["v_clipping_onset"],
+            mode='markers', marker=dict(color='#E8002D', size=9, symbol='diamond'),
+        ), secondary_y=True)
+        fig_temp.update_layout(
+            plot_bgcolor='#05050D',
+            paper_bgcolor='#05050D',
+            height=380,
+            margin=dict(l=50, r=50, t=30, b=40),
+            font=dict(color='white', family='monospace', size=11),
+            legend=dict(orientation='h', y=1.1, x=0.5, xanchor='center', font=dict(size=10)),
+            xaxis=dict(gridcolor='#1a1a28'),
+            yaxis=dict(title=T["clipping_s"], gridcolor='#1a1a28'),
+            yaxis2=dict(title='km/h', showgrid=False),
+        )
+        st.plotly_chart(fig_temp, use_container_width=True)
+        st.dataframe(pd.DataFrame({
+            T["segment"]:          etiquetas,
+            T["dist_start"]:       segmentos['dist_inicio'].round(0),
+            T["dist_end"]:         segmentos['dist_fin'].round(0),
+            T["laps_count"]:       segmentos['vueltas'],
+            T["clipping_s"]:       segmentos['clipping_s'].round(2),
+            T["deploy_mj"]:        segmentos['deploy_mj'].round(3),
+            T["harvest_mj"]:       segmentos['harvest_mj'].round(3),
+            T["clipping_events"]:  segmentos['n_clipping'].round(2),
+            T["v_clipping_onset"]: segmentos['v_clipping_max'].round(0),
+        }), hide_index=True, use_container_width=True)
+
+        with st.expander(T["season_laps"]):
+            sesiones = {s['session_key']: s['session_name'] for s in indice.sesiones_de(gp_opciones[sel_gp])}
+            st.dataframe(pd.DataFrame({
+                T["session"]:          vueltas_gp['session_key'].map(sesiones),
+                T["driver"]:           vueltas_gp['driver_number'].map(lambda n: nombres_piloto.get(n, f"#{n}")),
+                T["lap"]:              vueltas_gp['lap_number'],
+                T["harvest_mj"]:       vueltas_gp['harvest_mj'].round(3),
+                T["deploy_mj"]:        vueltas_gp['deploy_mj'].round(3),
+                T["clipping_s"]:       vueltas_gp['clipping_s'].round(2),
+                T["clipping_events"]:  vueltas_gp['n_clipping'],
+                T["v_clipping_onset"]: vueltas_gp['v_clipping_max'].round(0),
+            }), hide_index=True, use_container_width=True)
+
 # ─────────────────────────────────────────────
-#  VISTA 2: FAQ & METODOLOGÍA
+#  VISTA 3: FAQ & METODOLOGÍA
 # ─────────────────────────────────────────────
 elif v_seleccionada == T["faq"]:
     st.title(T["faq_title"])